@@ -0,0 +1,31 @@
+"""
+Minimal settings to run the benchmarks of this directory, from the root of
+the repository:
+
+    $ python benchmarks/country_select.py
+"""
+import os.path
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# userprofile and the profile model of the demo project
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'demo')]
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    }
+}
+INSTALLED_APPS = (
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
+    'django.contrib.sites',
+    'userprofile',
+    'demoprofile',
+)
+AUTH_PROFILE_MODULE = 'demoprofile.profile'
+SITE_ID = 1
+SECRET_KEY = 'benchmarks'
+LANGUAGE_CODE = 'en'
+USE_I18N = True
@@ -0,0 +1,40 @@
+"""
+Time of rendering the country select of LocationForm: a plain forms.Select
+against CountrySelect, which renders the options once per language and
+then only marks the selected one.
+
+    $ python benchmarks/country_select.py [--number=200 --repeat=5]
+"""
+from optparse import OptionParser
+import os
+import timeit
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bench_settings')
+import bench_settings
+
+from django import forms
+from django.db.models.fields import BLANK_CHOICE_DASH
+from django.utils import translation
+from userprofile.countries import CountrySelect, get_choices
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--number', type='int', default=200)
+    parser.add_option('--repeat', type='int', default=5)
+    options, args = parser.parse_args()
+
+    for language in ('en', 'es', 'ru'):
+        translation.activate(language)
+        choices = BLANK_CHOICE_DASH + get_choices()
+        widgets = (forms.Select(choices=choices), CountrySelect(choices=choices))
+        # same markup, from the cache from the second render on
+        for i in range(2):
+            assert widgets[0].render('country', 'ES') == widgets[1].render('country', 'ES')
+        for widget in widgets:
+            seconds = min(timeit.Timer(lambda: widget.render('country', 'ES')).repeat(options.repeat, options.number))
+            print "%s %-14s %8.3f ms" % (language, widget.__class__.__name__, seconds * 1000 / options.number)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Peak memory and time of shrinking a big uploaded JPEG to the 480px box of
+avatarchoose: the previous code (full decode, convert, thumbnail) against
+open_image() and shrink_image(). Every case runs in its own process, so its
+peak RSS isn't hidden by the others.
+
+    $ python benchmarks/draft_decode.py [--width=6000 --height=4000 --repeat=5]
+"""
+from optparse import OptionParser
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bench_settings')
+import bench_settings
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+BOX = 480
+
+
+def previous(data):
+    thumb = Image.open(StringIO(data))
+    if thumb.mode != "RGB":
+        thumb = thumb.convert("RGB")
+    thumb.thumbnail((BOX, BOX), Image.ANTIALIAS)
+    return thumb
+
+
+def current(data):
+    from userprofile.models import open_image, shrink_image
+    thumb, img_format = open_image(StringIO(data), BOX)
+    shrink_image(thumb, BOX)
+    return thumb
+
+
+def max_rss():
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def child(name, path, repeat):
+    function = globals()[name]
+    data = open(path, 'rb').read()
+    # load the modules and PIL plugins on a small image before measuring
+    small = StringIO()
+    Image.new('RGB', (16, 16)).save(small, 'JPEG')
+    function(small.getvalue())
+    baseline = max_rss()
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        function(data)
+        times.append(time.time() - start)
+    print "%d %f" % (max_rss() - baseline, min(times))
+
+
+def make_jpeg(width, height, mode):
+    gradient = Image.linear_gradient('L').resize((width, height))
+    if mode == 'L':
+        image = gradient
+    else:
+        image = Image.merge('RGB', (gradient, gradient.transpose(Image.FLIP_LEFT_RIGHT),
+                                    gradient.transpose(Image.FLIP_TOP_BOTTOM))).convert(mode)
+    f = tempfile.NamedTemporaryFile(suffix='.jpg', delete=False)
+    image.save(f, 'JPEG', quality=90)
+    f.close()
+    return f.name
+
+
+def measure(name, path, repeat):
+    output = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--child', name, path,
+                               '--repeat', str(repeat)], stdout=subprocess.PIPE).communicate()[0]
+    peak, seconds = output.split()
+    return int(peak) / 1024.0, float(seconds) * 1000
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--width', type='int', default=6000)
+    parser.add_option('--height', type='int', default=4000)
+    parser.add_option('--repeat', type='int', default=5)
+    parser.add_option('--child', default=None)
+    options, args = parser.parse_args()
+    if options.child:
+        return child(options.child, args[0], options.repeat)
+
+    version = getattr(Image, '__version__', None) or getattr(Image, 'VERSION', '?')
+    print "Pillow %s, %dx%d JPEG shrunk to %dpx" % (version, options.width, options.height, BOX)
+    for mode in ('RGB', 'L', 'CMYK'):
+        path = make_jpeg(options.width, options.height, mode)
+        try:
+            for name in ('previous', 'current'):
+                peak, ms = measure(name, path, options.repeat)
+                print "%-4s %-8s peak +%7.1f MB %8.1f ms" % (mode, name, peak, ms)
+        finally:
+            os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+"""
+Lookups per second of the offline geocoders: BoundariesGeocoder (GeoJSON
+loaded in every process, 1 degree grid of bounding boxes), a linear scan of
+its polygons, MappedGeocoder (boundaries compiled by compile_boundaries())
+and CachedGeocoder when the same places are looked up again. The time of the
+first lookup of a process and the private memory it takes are measured in
+child processes (Linux only). By default the boundaries are a generated world of jagged regions
+of VERTICES points, with a hole holding an enclave; any GeoJSON file (for
+instance the "admin 1" file of Natural Earth) can be given instead.
+
+    $ python benchmarks/geocoder.py [--boundaries=file.geojson --cell-size=0.25 --seconds=2]
+"""
+from optparse import OptionParser
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bench_settings')
+import bench_settings
+
+from django.utils import simplejson
+from userprofile.geodata import BoundariesGeocoder, CachedGeocoder, MappedGeocoder, compile_boundaries, \
+    contains
+
+# points of the outline of every generated region
+VERTICES = 400
+
+
+def star(rand, lat, lng, low, high, count):
+    ring = []
+    for i in range(count):
+        angle = 2 * math.pi * i / count
+        radius = rand.uniform(low, high)
+        ring.append([lng + radius * math.cos(angle), max(-90, min(90, lat + radius * math.sin(angle)))])
+    ring.append(ring[0])
+    return ring
+
+
+def make_boundaries():
+    rand = random.Random(0)
+    features = []
+    for lat in range(-85, 90, 10):
+        for lng in range(-175, 180, 10):
+            # a region around a lake, and an island in the lake
+            outline = star(rand, lat, lng, 2, 4.9, VERTICES)
+            hole = star(rand, lat, lng, 0.6, 1.2, VERTICES / 8)[::-1]
+            island = star(rand, lat, lng, 0.1, 0.5, VERTICES / 8)
+            for name, rings in (("%s,%s" % (lat, lng), [outline, hole]), ("island %s,%s" % (lat, lng), [island])):
+                features.append({
+                    'type': 'Feature',
+                    'properties': {'iso_a2': 'X%d' % (len(features) / 2), 'name': name},
+                    'geometry': {'type': 'Polygon', 'coordinates': rings},
+                })
+    f = tempfile.NamedTemporaryFile(suffix='.geojson', delete=False)
+    simplejson.dump({'type': 'FeatureCollection', 'features': features}, f)
+    f.close()
+    return f.name
+
+
+def linear_scan(geocoder, lat, lng):
+    for region, bbox, rings in geocoder.polygons:
+        if bbox[0] <= lat <= bbox[2] and bbox[1] <= lng <= bbox[3] and contains(rings[0], lng, lat) and \
+           not [hole for hole in rings[1:] if contains(hole, lng, lat)]:
+            return dict(geocoder.regions[region])
+    return None
+
+
+def rate(function, points, seconds):
+    count = 0
+    start = time.time()
+    while time.time() - start < seconds:
+        for lat, lng in points:
+            function(lat, lng)
+        count += len(points)
+    return count / (time.time() - start)
+
+
+def child(name, path):
+    if name == 'geojson':
+        geocoder = BoundariesGeocoder(path, 'iso_a2', 'name')
+    else:
+        geocoder = MappedGeocoder(path)
+    baseline = private_memory()
+    start = time.time()
+    geocoder.lookup(0, 0)
+    print "%d %f" % (private_memory() - baseline, time.time() - start)
+
+
+def private_memory():
+    """
+    Resident bytes of the process not shared with others (Linux only), the
+    pages of mapped files being shared
+    """
+    size, resident, shared = open('/proc/self/statm').read().split()[:3]
+    return (int(resident) - int(shared)) * os.sysconf('SC_PAGE_SIZE')
+
+
+def first_lookup(name, path):
+    output = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--child', name, path],
+                              stdout=subprocess.PIPE).communicate()[0]
+    memory, seconds = output.split()
+    return int(memory) / 2.0 ** 20, float(seconds) * 1000
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--boundaries', default=None)
+    parser.add_option('--cell-size', type='float', default=0.25)
+    parser.add_option('--seconds', type='float', default=2)
+    parser.add_option('--child', default=None)
+    options, args = parser.parse_args()
+    if options.child:
+        return child(options.child, args[0])
+
+    filename = options.boundaries or make_boundaries()
+    compiled = tempfile.mktemp(suffix='.boundaries')
+    try:
+        geocoder = BoundariesGeocoder(filename, 'iso_a2', 'name')
+        geocoder.load()
+        start = time.time()
+        stats = compile_boundaries(geocoder, compiled, options.cell_size)
+        print "%d polygons, %d edges compiled in %.2fs, %d of %d cells on borders, %.1f MB" % \
+              (stats['polygons'], stats['edges'], time.time() - start, stats['border cells'], stats['cells'],
+               os.path.getsize(compiled) / 2.0 ** 20)
+        for name, path in (('geojson', filename), ('compiled', compiled)):
+            memory, ms = first_lookup(name, path)
+            print "first lookup, %-8s %8.1f ms  +%6.1f MB per process" % (name, ms, memory)
+
+        rand = random.Random(0)
+        points = [(rand.uniform(-60, 70), rand.uniform(-180, 180)) for i in range(1000)]
+        mapped = MappedGeocoder(compiled)
+        for lat, lng in points:
+            assert mapped.lookup(lat, lng) == geocoder.lookup(lat, lng)
+        print "geojson, 1 degree grid %10.0f lookups/s" % rate(geocoder.lookup, points, options.seconds)
+        print "linear scan            %10.0f lookups/s" % rate(lambda lat, lng: linear_scan(geocoder, lat, lng),
+                                                          points[:50], options.seconds)
+        print "compiled, %.2f grid    %10.0f lookups/s" % (options.cell_size,
+                                                          rate(mapped.lookup, points, options.seconds))
+        cached = CachedGeocoder(mapped)
+        for lat, lng in points:
+            cached.lookup(lat, lng)
+        print "cached (repeated)      %10.0f lookups/s" % rate(cached.lookup, points, options.seconds)
+    finally:
+        if not options.boundaries:
+            os.unlink(filename)
+        if os.path.exists(compiled):
+            os.unlink(compiled)
+
+
+if __name__ == '__main__':
+    main()
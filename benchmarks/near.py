@@ -0,0 +1,80 @@
+"""
+Time of Profile.objects.near() against a naive scan computing the distance
+of every profile with coordinates, on a database of generated profiles
+(half of them around a few cities, the others anywhere).
+
+    $ python benchmarks/near.py [--profiles=20000 --repeat=20]
+"""
+from optparse import OptionParser
+import os
+import random
+import time
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bench_settings')
+import bench_settings
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import transaction
+from userprofile import geohash
+from userprofile.models import get_profile_model
+
+CITIES = [(40.42, -3.70), (48.86, 2.35), (51.51, -0.13), (40.71, -74.01), (35.69, 139.69),
+          (-33.87, 151.21), (-23.55, -46.63), (19.43, -99.13), (55.76, 37.62), (-1.29, 36.82)]
+
+
+def populate(count):
+    Profile = get_profile_model()
+    rand = random.Random(0)
+    transaction.enter_transaction_management()
+    transaction.managed(True)
+    for i in range(count):
+        if i % 2:
+            lat, lng = rand.choice(CITIES)
+            lat, lng = lat + rand.gauss(0, 0.5), lng + rand.gauss(0, 0.5)
+        else:
+            lat, lng = rand.uniform(-60, 70), rand.uniform(-180, 180)
+        user = User.objects.create(username='user%d' % i)
+        Profile.objects.create(user=user, latitude="%.6f" % lat, longitude="%.6f" % lng)
+    transaction.commit()
+    transaction.leave_transaction_management()
+
+
+def naive(lat, lng, radius):
+    found = []
+    for profile in get_profile_model().objects.exclude(latitude=None):
+        profile.distance = geohash.distance(lat, lng, float(profile.latitude), float(profile.longitude))
+        if profile.distance <= radius:
+            found.append(profile)
+    found.sort(key=lambda profile: profile.distance)
+    return found
+
+
+def best(function, repeat, *args):
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        result = function(*args)
+        times.append(time.time() - start)
+    return min(times) * 1000, len(result)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--profiles', type='int', default=20000)
+    parser.add_option('--repeat', type='int', default=20)
+    options, args = parser.parse_args()
+
+    call_command('syncdb', interactive=False, verbosity=0)
+    start = time.time()
+    populate(options.profiles)
+    print "%d profiles created in %.1fs" % (options.profiles, time.time() - start)
+    naive_ms, count = best(naive, max(1, options.repeat / 10), 48.86, 2.35, 10)
+    print "naive scan        %8.2f ms" % naive_ms
+    for radius in (1, 10, 100, 1000):
+        ms, count = best(get_profile_model().objects.near, options.repeat, 48.86, 2.35, radius)
+        print "near() %5d km   %8.2f ms  %5d profiles" % (radius, ms, count)
+
+
+if __name__ == '__main__':
+    main()
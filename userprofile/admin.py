@@ -1,10 +1,15 @@
 from django.contrib import admin
-from models import EmailValidation, Avatar
+from models import EmailValidation, Avatar, QueuedEmail
 
 
 class EmailValidationAdmin(admin.ModelAdmin):
     list_display = ('__unicode__',)
     search_fields = ('user__username', 'user__first_name')
 
+class QueuedEmailAdmin(admin.ModelAdmin):
+    list_display = ('__unicode__', 'created', 'attempts', 'next_attempt')
+    search_fields = ('recipients', 'subject')
+
 admin.site.register(Avatar)
 admin.site.register(EmailValidation, EmailValidationAdmin)
+admin.site.register(QueuedEmail, QueuedEmailAdmin)
@@ -3,10 +3,14 @@
 # Countries list - ISO 3166-1993 (E)
 # http://xml.coverpages.org/country3166.html
 
+from django import forms
+from django.core import validators
 from django.core.exceptions import ValidationError
 from django.db.models.fields import CharField
 from django.template.defaultfilters import slugify
-from django.utils.translation import ugettext_lazy as _, ugettext
+from django.utils.encoding import force_unicode
+from django.utils.html import escape
+from django.utils.translation import ugettext_lazy as _, ugettext, get_language
 
 
 COUNTRIES = [
@@ -250,18 +254,92 @@ COUNTRIES = [
     ('ZW', _('Zimbabwe')),
 ]
 
-COUNTRIES.sort(lambda x, y:cmp(slugify(x[1]), slugify(y[1])))
 COUNTRIES.append(('ZZ', _('Unknown or unspecified country')))
 
+COUNTRY_CODES = frozenset([code for code, name in COUNTRIES])
+
+# language => (choices sorted by name, dict of code => name)
+_translated = {}
+
+def _get_translated():
+    language = get_language()
+    translated = _translated.get(language)
+    if translated is None:
+        choices = [(code, unicode(name)) for code, name in COUNTRIES[:-1]]
+        choices.sort(key=lambda choice: slugify(choice[1]))
+        choices.append((COUNTRIES[-1][0], unicode(COUNTRIES[-1][1])))
+        translated = _translated[language] = (choices, dict(choices))
+    return translated
+
+def get_choices():
+    """
+    Return the list of (code, name) of the countries in the active language,
+    sorted by name, with the unknown country at the end. The list is built
+    once per language: don't modify it.
+    """
+    return _get_translated()[0]
+
+def get_country_name(code):
+    """
+    Name of the country in the active language, or None if unknown
+    """
+    return _get_translated()[1].get(code)
+
 def isValidCountry(field_data, all_data):
-    if not field_data in [lang[0] for lang in COUNTRIES]:
+    if not field_data in COUNTRY_CODES:
         raise ValidationError, ugettext("This value must be in COUNTRIES setting in localflavor.generic package.")
 
+class CountryChoices(object):
+    """
+    Choices of CountryField, sorted in the active language every time they
+    are iterated
+    """
+    def __iter__(self):
+        return iter(get_choices())
+
+    def __len__(self):
+        return len(COUNTRIES)
+
+class CountrySelect(forms.Select):
+    """
+    Select of the countries whose options are rendered once per language
+    and set of choices, and then only the selected option is marked
+    """
+    # (language, choices) => options without any selected
+    rendered = {}
+
+    def render_options(self, choices, selected_choices):
+        if choices:
+            return super(CountrySelect, self).render_options(choices, selected_choices)
+        key = (get_language(), tuple(self.choices))
+        options = self.rendered.get(key)
+        if options is None:
+            options = self.rendered[key] = super(CountrySelect, self).render_options((), ())
+        for value in set([force_unicode(value) for value in selected_choices]):
+            option = u'<option value="%s">' % escape(value)
+            options = options.replace(option, option[:-1] + u' selected="selected">', 1)
+        return options
+
 class CountryField(CharField):
     def __init__(self, *args, **kwargs):
         kwargs.setdefault('max_length', 2)
-        kwargs.setdefault('choices', COUNTRIES)
+        kwargs.setdefault('choices', CountryChoices())
         super(CharField, self).__init__(*args, **kwargs)
 
     def get_internal_type(self):
         return "CharField"
+
+    def formfield(self, **kwargs):
+        kwargs.setdefault('widget', CountrySelect)
+        return super(CountryField, self).formfield(**kwargs)
+
+    def validate(self, value, model_instance):
+        # Same as Field.validate(), but checking the choices on a set
+        if not self.editable:
+            return
+        if value and value not in COUNTRY_CODES:
+            raise ValidationError(self.error_messages['invalid_choice'] % value)
+        if value is None and not self.null:
+            raise ValidationError(self.error_messages['null'])
+        if not self.blank and value in validators.EMPTY_VALUES:
+            raise ValidationError(self.error_messages['blank'])
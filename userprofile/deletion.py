@@ -0,0 +1,95 @@
+"""
+Removal of avatar files from the storage: in a single call if the storage
+supports it, otherwise in parallel, and optionally after the response
+"""
+from django.db import connection
+import Queue
+import logging
+import os
+import settings
+import threading
+
+logger = logging.getLogger('userprofile.deletion')
+
+
+def delete_files(storage, names):
+    """
+    Delete the given files from the storage, using its delete_many() method
+    if it has one (batch deletion of remote storages) or a few threads so
+    the round trips overlap. Errors are logged, not raised.
+    """
+    names = sorted(set(names))
+    if not names:
+        return
+    delete_many = getattr(storage, 'delete_many', None)
+    if delete_many is not None:
+        try:
+            delete_many(names)
+        except:
+            logger.exception("Can't delete %d files" % len(names))
+        return
+
+    queue = Queue.Queue()
+    for name in names:
+        queue.put(name)
+
+    def run():
+        while True:
+            try:
+                name = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                storage.delete(name)
+            except:
+                logger.exception("Can't delete %s" % name)
+
+    threads = [threading.Thread(target=run) for i in range(min(settings.AVATAR_DELETE_WORKERS, len(names)) - 1)]
+    for thread in threads:
+        thread.start()
+    # the current thread works too
+    run()
+    for thread in threads:
+        thread.join()
+
+
+class DeferredDeletions(object):
+    """
+    Daemon thread running deletions after the response (AVATAR_DEFERRED_DELETE),
+    one submitted call at a time. The thread is started on the first submit
+    of every process, so it's safe to import this module before the web
+    server forks.
+    """
+
+    def __init__(self):
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.queue = Queue.Queue()
+        thread = threading.Thread(target=self.run, name="avatar-deletions")
+        thread.setDaemon(True)
+        thread.start()
+
+    def submit(self, function, *args):
+        self.lock.acquire()
+        try:
+            if self.pid != os.getpid():
+                self.reset()
+        finally:
+            self.lock.release()
+        self.queue.put((function, args))
+
+    def run(self):
+        while True:
+            function, args = self.queue.get()
+            try:
+                function(*args)
+            except:
+                logger.exception("Deferred deletion failed")
+            # don't keep a connection (or a transaction) open between jobs
+            connection.close()
+
+
+deferred = DeferredDeletions()
@@ -9,3 +9,6 @@ class GoogleDataAPINotFound(Exception):
 
 class CustomUploadError(Exception):
     pass
+
+class RemoteImageError(Exception):
+    pass
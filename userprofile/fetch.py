@@ -0,0 +1,120 @@
+"""
+Download of avatar images from remote urls, bounded in time, size and
+concurrency, keeping the recent downloads in the cache
+"""
+from django.core.cache import cache
+from django.core.files.uploadedfile import UploadedFile
+from django.utils.encoding import smart_str
+from django.utils.translation import ugettext as _
+from exceptions import RemoteImageError
+from uploadhandler import is_image_header
+import hashlib
+import httplib
+import posixpath
+import settings
+import tempfile
+import threading
+import time
+import urllib2
+import urlparse
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+CHUNK_SIZE = 64 * 2 ** 10
+
+CACHE_PREFIX = 'userprofile.fetch'
+
+# downloads allowed at the same time on every process
+slots = threading.BoundedSemaphore(settings.AVATAR_FETCH_CONCURRENCY)
+
+
+def spooled_file(name, content_type, data=None):
+    f = tempfile.SpooledTemporaryFile(max_size=settings.AVATAR_SPOOL_MAX_SIZE)
+    if data:
+        f.write(data)
+        f.seek(0)
+    return UploadedFile(f, name, content_type, data and len(data) or 0)
+
+
+def fetch_image(url):
+    """
+    Return an UploadedFile with the image at url, or raise RemoteImageError
+    with a message for the user. Images up to AVATAR_SPOOL_MAX_SIZE bytes are
+    remembered in the cache for AVATAR_FETCH_CACHE_TIMEOUT seconds, so
+    submitting the same url again doesn't download it again.
+    """
+    key = "%s.%s" % (CACHE_PREFIX, hashlib.md5(smart_str(url)).hexdigest())
+    cached = cache.get(key)
+    if cached is not None:
+        return spooled_file(*cached)
+
+    # don't let slow hosts tie up every worker of the process
+    if not slots.acquire(False):
+        raise RemoteImageError(_("Too many images are being downloaded, please try again later"))
+    try:
+        f = download(url)
+    finally:
+        slots.release()
+
+    if f.size <= settings.AVATAR_SPOOL_MAX_SIZE:
+        cache.set(key, (f.name, f.content_type, f.read()), settings.AVATAR_FETCH_CACHE_TIMEOUT)
+        f.seek(0)
+    return f
+
+
+def download(url):
+    """
+    Stream the url into a spooled file, giving up after AVATAR_FETCH_TIMEOUT
+    seconds without data, AVATAR_FETCH_MAX_TIME seconds in total or
+    AVATAR_FETCH_MAX_SIZE bytes, and as soon as the first chunk doesn't look
+    like an image
+    """
+    invalid = RemoteImageError(_("This URL doesn't point to a valid image"))
+    too_big = RemoteImageError(_("The image is bigger than %d KB") % (settings.AVATAR_FETCH_MAX_SIZE / 2 ** 10))
+    if urlparse.urlparse(url).scheme not in ('http', 'https'):
+        raise invalid
+    try:
+        response = urllib2.urlopen(url, timeout=settings.AVATAR_FETCH_TIMEOUT)
+    except (IOError, ValueError, httplib.HTTPException):
+        raise invalid
+
+    try:
+        length = response.info().get('Content-Length', '')
+        if length.isdigit() and int(length) > settings.AVATAR_FETCH_MAX_SIZE:
+            raise too_big
+
+        name = posixpath.basename(urlparse.urlparse(url).path) or 'avatar'
+        f = spooled_file(name, response.info().gettype())
+        deadline = time.time() + settings.AVATAR_FETCH_MAX_TIME
+        while True:
+            try:
+                chunk = response.read(CHUNK_SIZE)
+            except (IOError, httplib.HTTPException):
+                raise invalid
+            if not chunk:
+                break
+            if not f.size and not is_image_header(chunk):
+                raise invalid
+            f.size += len(chunk)
+            if f.size > settings.AVATAR_FETCH_MAX_SIZE:
+                raise too_big
+            if time.time() > deadline:
+                raise RemoteImageError(_("The image took too long to download"))
+            f.write(chunk)
+    finally:
+        response.close()
+
+    # only the header is parsed here, the image is decoded by the view
+    f.seek(0)
+    try:
+        image = Image.open(f)
+    except Exception:
+        raise invalid
+    width, height = image.size
+    if width * height > settings.AVATAR_MAX_PIXELS:
+        raise RemoteImageError(_("The image is too big (%(width)dx%(height)d pixels)") % { 'width': width, 'height': height })
+    f.content_type = Image.MIME.get(image.format, f.content_type)
+    f.seek(0)
+    return f
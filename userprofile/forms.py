@@ -2,13 +2,14 @@ from django import forms
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.models import User, SiteProfileNotAvailable
 from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist
-from django.core.files.uploadedfile import SimpleUploadedFile
 from django.db import models
+from django.db.models.fields import BLANK_CHOICE_DASH
 from django.utils.translation import ugettext as _
+from userprofile.countries import get_choices
+from userprofile.exceptions import RemoteImageError
+from userprofile.fetch import fetch_image
 from userprofile.models import EmailValidation
-import mimetypes
 import settings
-import urllib
 
 if not settings.AUTH_PROFILE_MODULE:
     raise SiteProfileNotAvailable
@@ -27,6 +28,12 @@ class LocationForm(forms.ModelForm):
         model = Profile
         fields = ('location', 'latitude', 'longitude', 'country')
 
+    def __init__(self, *args, **kwargs):
+        super(LocationForm, self).__init__(*args, **kwargs)
+        # the choices of the form class are sorted in the language active
+        # when it was defined
+        self.fields['country'].choices = BLANK_CHOICE_DASH + get_choices()
+
 class ProfileForm(forms.ModelForm):
     """
     Profile Form. Composed by all the Profile model fields.
@@ -55,12 +62,9 @@ class AvatarForm(forms.Form):
         url = self.cleaned_data.get('url')
         if not url: return ''
         try:
-            filename, headers = urllib.urlretrieve(url)
-        except:
-            raise forms.ValidationError(forms.fields.URLField.default_error_messages['invalid_link'])
-        if not mimetypes.guess_all_extensions(headers.get('Content-Type')):
-            raise forms.ValidationError(_('The file type is invalid: %s' % type))
-        return SimpleUploadedFile(filename, open(filename).read(), content_type=headers.get('Content-Type'))
+            return fetch_image(url)
+        except RemoteImageError, e:
+            raise forms.ValidationError(e.args[0])
 
     def clean(self):
         if not (self.cleaned_data.get('photo') or self.cleaned_data.get('url')):
@@ -143,7 +147,8 @@ class EmailValidationForm(forms.Form):
 
     def clean_email(self):
         """
-        Verify that the email exists
+        Verify that the email exists. Pending changes are only known without
+        EMAIL_VALIDATION_SIGNED; signed keys are checked again on validation.
         """
         email = self.cleaned_data.get("email")
         if not (User.objects.filter(email=email) or EmailValidation.objects.filter(email=email)):
@@ -0,0 +1,539 @@
+"""
+Reverse geocoding of the location form: coordinates => country code and
+first level administrative region (state, province...)
+"""
+from django.core.cache import cache
+from django.utils import simplejson
+from xml.dom import minidom
+import array
+import logging
+import math
+import mmap
+import os
+import settings
+import struct
+import threading
+import time
+import urllib2
+
+logger = logging.getLogger('userprofile.geodata')
+
+
+class GeonamesGeocoder(object):
+    """
+    Remote geocoder using the countrySubdivision web service of geonames.org
+    """
+    url = "http://ws.geonames.org/countrySubdivision?lat=%s&lng=%s"
+
+    def lookup(self, lat, lng):
+        try:
+            dom = minidom.parse(urllib2.urlopen(self.url % (lat, lng), timeout=settings.GEODATA_TIMEOUT))
+        except Exception:
+            logger.exception("Can't fetch the geodata of %s,%s" % (lat, lng))
+            return None
+        result = {}
+        for key, tag in (('country', 'countryCode'), ('region', 'adminName1')):
+            nodes = dom.getElementsByTagName(tag)
+            if nodes and nodes[0].childNodes:
+                result[key] = nodes[0].childNodes[0].data
+        if not result:
+            return None
+        return result
+
+
+class BoundariesGeocoder(object):
+    """
+    Offline geocoder over a GeoJSON file of the boundaries of the regions
+    (GEODATA_BOUNDARIES, for instance the "admin 1" file of Natural Earth).
+    Polygons are indexed on a grid of cells of CELL_SIZE degrees, so a
+    lookup only tests the points of the few polygons around the coordinates.
+    The file is loaded on the first lookup of every process.
+    """
+
+    CELL_SIZE = 1.0
+
+    def __init__(self, filename, country_property, region_property):
+        self.filename = filename
+        self.country_property = country_property
+        self.region_property = region_property
+        self.lock = threading.Lock()
+        self.grid = None
+
+    def load(self):
+        self.regions = []
+        self.polygons = []
+        self.grid = {}
+        data = simplejson.load(open(self.filename))
+        for feature in data['features']:
+            geometry = feature.get('geometry') or {}
+            if geometry.get('type') == 'Polygon':
+                polygons = [geometry['coordinates']]
+            elif geometry.get('type') == 'MultiPolygon':
+                polygons = geometry['coordinates']
+            else:
+                continue
+            properties = feature.get('properties') or {}
+            region = {
+                'country': properties.get(self.country_property) or '',
+                'region': properties.get(self.region_property) or '',
+            }
+            self.regions.append(region)
+            for rings in polygons:
+                self.add_polygon(len(self.regions) - 1, rings)
+
+    def add_polygon(self, region, rings):
+        # rings of GeoJSON coordinates ([lng, lat] pairs), the first one is
+        # the outline and the others are holes, stored as flat arrays
+        rings = [array.array('d', [c for point in ring for c in point[:2]]) for ring in rings]
+        outline = rings[0]
+        bbox = (min(outline[1::2]), min(outline[0::2]), max(outline[1::2]), max(outline[0::2]))
+        index = len(self.polygons)
+        self.polygons.append((region, bbox, rings))
+        for row in range(self.cell(bbox[0]), self.cell(bbox[2]) + 1):
+            for column in range(self.cell(bbox[1]), self.cell(bbox[3]) + 1):
+                self.grid.setdefault((row, column), []).append(index)
+
+    def cell(self, degrees):
+        return int(math.floor(degrees / self.CELL_SIZE))
+
+    def lookup(self, lat, lng):
+        if self.grid is None:
+            self.lock.acquire()
+            try:
+                if self.grid is None:
+                    self.load()
+            finally:
+                self.lock.release()
+        for index in self.grid.get((self.cell(lat), self.cell(lng)), ()):
+            region, bbox, rings = self.polygons[index]
+            if not (bbox[0] <= lat <= bbox[2] and bbox[1] <= lng <= bbox[3]):
+                continue
+            # inside the outline and outside every hole
+            if contains(rings[0], lng, lat) and \
+               not [hole for hole in rings[1:] if contains(hole, lng, lat)]:
+                return dict(self.regions[region])
+        return None
+
+
+def contains(ring, x, y):
+    """
+    Whether the point is inside the ring (flat array of x, y coordinates),
+    by ray casting
+    """
+    inside = False
+    count = len(ring) / 2
+    j = count - 1
+    for i in range(count):
+        xi, yi = ring[2 * i], ring[2 * i + 1]
+        xj, yj = ring[2 * j], ring[2 * j + 1]
+        if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+            inside = not inside
+        j = i
+    return inside
+
+
+class MappedGeocoder(object):
+    """
+    Offline geocoder over a boundaries file compiled by compile_boundaries()
+    ("manage.py compile_boundaries"). The file is memory mapped, so every
+    process shares the same pages of the OS cache instead of parsing and
+    holding its own copy of the boundaries. It's indexed on a grid of small
+    cells: the cells inside a single region give it right away, and only
+    the points of the cells crossed by a border are tested against the
+    polygons of that border, ray casting over the few edges of the polygon
+    in a narrow band of latitude.
+    """
+
+    def __init__(self, filename, data=None):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.data = None
+        if data is not None:
+            self.read_header(data)
+
+    def open(self):
+        f = open(self.filename, 'rb')
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        self.read_header(data)
+
+    def read_header(self, data):
+        (magic, self.cell_size, self.rows, self.columns, regions_offset, regions_length, self.grid_offset,
+         self.lists_offset, self.polygons_offset, self.slabs_offset, self.edges_offset,
+         self.coords_offset) = HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ValueError("%s isn't a compiled boundaries file" % self.filename)
+        regions = simplejson.loads(data[regions_offset:regions_offset + regions_length])
+        self.regions = [{'country': country, 'region': region} for country, region in regions]
+        # set last, lookups don't lock once it's set
+        self.data = data
+
+    def cell(self, lat, lng):
+        row = min(max(int(math.floor((lat + 90) / self.cell_size)), 0), self.rows - 1)
+        column = min(max(int(math.floor((lng + 180) / self.cell_size)), 0), self.columns - 1)
+        return row * self.columns + column
+
+    def contains(self, polygon, lat, lng):
+        """
+        Whether the polygon (index) contains the point
+        """
+        min_lat, min_lng, max_lat, max_lng, slab_height, region, slabs, first_slab = \
+            POLYGON.unpack_from(self.data, self.polygons_offset + polygon * POLYGON.size)
+        if not (min_lat <= lat <= max_lat and min_lng <= lng <= max_lng):
+            return False
+        slab = min(int((lat - min_lat) / slab_height), slabs - 1)
+        start, count = SLAB.unpack_from(self.data, self.slabs_offset + (first_slab + slab) * SLAB.size)
+        inside = False
+        # ray casting over the edges of the outline and the holes in the
+        # band of the point
+        for edge in struct.unpack_from('<%di' % count, self.data, self.edges_offset + start * 4):
+            xi, yi, xj, yj = EDGE.unpack_from(self.data, self.coords_offset + edge * 16)
+            if (yi > lat) != (yj > lat) and lng < (xj - xi) * (lat - yi) / (yj - yi) + xi:
+                inside = not inside
+        return inside
+
+    def locate(self, lat, lng):
+        """
+        Index of the region of the point, or None
+        """
+        entry = struct.unpack_from('<i', self.data, self.grid_offset + self.cell(lat, lng) * 4)[0]
+        if entry == -1:
+            return None
+        if entry >= 0:
+            return entry
+        # a cell crossed by borders: list of the polygons with an edge in it
+        offset = self.lists_offset + (-2 - entry) * 4
+        count = struct.unpack_from('<i', self.data, offset)[0]
+        for polygon in struct.unpack_from('<%di' % count, self.data, offset + 4):
+            if self.contains(polygon, lat, lng):
+                return POLYGON.unpack_from(self.data, self.polygons_offset + polygon * POLYGON.size)[5]
+        return None
+
+    def lookup(self, lat, lng):
+        if self.data is None:
+            self.lock.acquire()
+            try:
+                if self.data is None:
+                    self.open()
+            finally:
+                self.lock.release()
+        region = self.locate(lat, lng)
+        if region is None:
+            return None
+        return dict(self.regions[region])
+
+
+# Compiled boundaries file: header, regions (JSON list of [country, region]),
+# polygons (bounding box, height of the latitude bands, region, number and
+# first of its bands), bands (first and number of their edges), edges (index
+# of their first point), points (lng, lat), grid (cell => -1 if outside every
+# region, region if inside a single one, or -2 - offset of its polygon list)
+# and polygon lists (number of polygons, polygons), little endian
+MAGIC = 'UPGEO\x00\x01\x00'
+HEADER = struct.Struct('<8sd10i')
+POLYGON = struct.Struct('<5d3i')
+SLAB = struct.Struct('<2i')
+EDGE = struct.Struct('<4d')
+
+
+def compile_boundaries(geocoder, filename, cell_size=0.25):
+    """
+    Write the boundaries of a BoundariesGeocoder to a file for
+    MappedGeocoder, indexed on a grid of cell_size degrees (dividing 180).
+    The regions shouldn't overlap, enclaves being holes of the regions
+    around them.
+    """
+    if geocoder.grid is None:
+        geocoder.load()
+    rows, columns = int(round(180 / cell_size)), int(round(360 / cell_size))
+    if abs(rows * cell_size - 180) > 1e-9:
+        raise ValueError("The cell size doesn't divide 180 degrees")
+
+    polygons = []
+    slabs = array.array('i')
+    edges = array.array('i')
+    coords = array.array('d')
+    # cell => polygons with an edge in it
+    borders = {}
+    edge_count = 0
+    epsilon = 1e-9
+
+    def cell(degrees, offset, count):
+        return min(max(int(math.floor((degrees + offset) / cell_size)), 0), count - 1)
+
+    for index, (region, bbox, rings) in enumerate(geocoder.polygons):
+        polygon_edges = []
+        for ring in rings:
+            first = len(coords) / 2
+            coords.extend(ring)
+            if ring[:2] != ring[-2:]:
+                coords.extend(ring[:2])
+            polygon_edges.extend(range(first, len(coords) / 2 - 1))
+        edge_count += len(polygon_edges)
+        min_lat, min_lng, max_lat, max_lng = bbox
+        count = max(1, min(len(polygon_edges) / 4, 4096))
+        height = (max_lat - min_lat) / count or 1.0
+        bands = [[] for i in range(count)]
+        for edge in polygon_edges:
+            x0, y0, x1, y1 = coords[2 * edge:2 * edge + 4]
+            low = min(max(int((min(y0, y1) - min_lat) / height), 0), count - 1)
+            high = min(max(int((max(y0, y1) - min_lat) / height), 0), count - 1)
+            for band in range(low, high + 1):
+                bands[band].append(edge)
+            # cells crossed by the edge, column by column
+            if x0 > x1:
+                x0, y0, x1, y1 = x1, y1, x0, y0
+            for column in range(cell(x0 - epsilon, 180, columns), cell(x1 + epsilon, 180, columns) + 1):
+                if x1 == x0:
+                    ya, yb = y0, y1
+                else:
+                    xa = max(x0, column * cell_size - 180)
+                    xb = min(x1, (column + 1) * cell_size - 180)
+                    ya = y0 + (y1 - y0) * (xa - x0) / (x1 - x0)
+                    yb = y0 + (y1 - y0) * (xb - x0) / (x1 - x0)
+                for row in range(cell(min(ya, yb) - epsilon, 90, rows), cell(max(ya, yb) + epsilon, 90, rows) + 1):
+                    borders.setdefault(row * columns + column, set()).add(index)
+        polygons.append(POLYGON.pack(min_lat, min_lng, max_lat, max_lng, height, region, count, len(slabs) / 2))
+        for band in bands:
+            slabs.extend((len(edges), len(band)))
+            edges.extend(band)
+
+    regions = simplejson.dumps([(r['country'], r['region']) for r in geocoder.regions])
+    sections = [regions, ''.join(polygons), slabs.tostring(), edges.tostring(), coords.tostring()]
+    offsets = []
+    offset = HEADER.size
+    for section in sections:
+        offsets.append(offset)
+        offset += len(section)
+    grid_offset = offset
+    lists_offset = grid_offset + rows * columns * 4
+    header = HEADER.pack(MAGIC, cell_size, rows, columns, offsets[0], len(regions), grid_offset,
+                         lists_offset, offsets[1], offsets[2], offsets[3], offsets[4])
+    # the polygons can be tested before writing the grid
+    mapped = MappedGeocoder(filename, header + ''.join(sections))
+
+    grid = array.array('i', [-1]) * (rows * columns)
+    lists = array.array('i')
+    for row in range(rows):
+        region = None
+        for column in range(columns):
+            index = row * columns + column
+            if index in borders:
+                grid[index] = -2 - len(lists)
+                lists.append(len(borders[index]))
+                lists.extend(sorted(borders[index]))
+                region = None
+                continue
+            if region is None:
+                # a run of cells without borders, all in the region of its
+                # first cell
+                lat = (row + 0.5) * cell_size - 90
+                lng = (column + 0.5) * cell_size - 180
+                region = -1
+                for polygon in geocoder.grid.get((geocoder.cell(lat), geocoder.cell(lng)), ()):
+                    if mapped.contains(polygon, lat, lng):
+                        region = geocoder.polygons[polygon][0]
+                        break
+            grid[index] = region
+
+    f = open(filename, 'wb')
+    try:
+        f.write(header)
+        for section in sections:
+            f.write(section)
+        f.write(grid.tostring())
+        f.write(lists.tostring())
+    finally:
+        f.close()
+    return {'polygons': len(polygons), 'edges': edge_count, 'cells': rows * columns,
+            'border cells': len(borders)}
+
+
+class LRUCache(object):
+    """
+    Thread safe mapping of limited size, dropping the least recently used
+    keys first
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        # circular doubly linked list of [previous, next, key, value] links,
+        # from the least to the most recently used
+        self.links = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+
+    def __len__(self):
+        return len(self.links)
+
+    def get(self, key, default=None):
+        self.lock.acquire()
+        try:
+            link = self.links.get(key)
+            if link is None:
+                return default
+            self.unlink(link)
+            self.append(link)
+            return link[3]
+        finally:
+            self.lock.release()
+
+    def set(self, key, value):
+        self.lock.acquire()
+        try:
+            link = self.links.get(key)
+            if link is not None:
+                self.unlink(link)
+            elif len(self.links) >= self.size:
+                oldest = self.root[1]
+                self.unlink(oldest)
+                del self.links[oldest[2]]
+            link = self.links[key] = [None, None, key, value]
+            self.append(link)
+        finally:
+            self.lock.release()
+
+    def unlink(self, link):
+        previous, next = link[0], link[1]
+        previous[1] = next
+        next[0] = previous
+
+    def append(self, link):
+        last = self.root[0]
+        link[0], link[1] = last, self.root
+        last[1] = self.root[0] = link
+
+
+class CachedGeocoder(object):
+    """
+    Cache of the lookups of a geocoder, keyed by the coordinates rounded to
+    GEODATA_CACHE_PRECISION decimals, so moving the map pin around the same
+    place doesn't query it again. Results are kept in a LRU cache of every
+    process and, if GEODATA_CACHE_TIMEOUT is set, in the django cache.
+    Unknown places (or failed lookups) are remembered for
+    GEODATA_NEGATIVE_CACHE_TIMEOUT seconds.
+    """
+
+    prefix = 'userprofile.geodata'
+
+    def __init__(self, geocoder):
+        self.geocoder = geocoder
+        self.local = LRUCache(settings.GEODATA_CACHE_SIZE)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, lat, lng):
+        precision = settings.GEODATA_CACHE_PRECISION
+        return "%.*f,%.*f" % (precision, lat, precision, lng)
+
+    def lookup(self, lat, lng):
+        key = self.key(lat, lng)
+        # (result, expiration time) pairs, the result is {} if unknown
+        cached = self.local.get(key)
+        if cached is None and settings.GEODATA_CACHE_TIMEOUT:
+            cached = cache.get("%s.%s" % (self.prefix, key))
+            if cached is not None:
+                self.local.set(key, cached)
+        if cached is not None and (cached[1] is None or cached[1] > time.time()):
+            self.hits += 1
+            return cached[0] or None
+
+        self.misses += 1
+        result = self.geocoder.lookup(lat, lng) or {}
+        expires = None
+        if not result:
+            expires = time.time() + settings.GEODATA_NEGATIVE_CACHE_TIMEOUT
+        self.local.set(key, (result, expires))
+        if settings.GEODATA_CACHE_TIMEOUT:
+            timeout = result and settings.GEODATA_CACHE_TIMEOUT or settings.GEODATA_NEGATIVE_CACHE_TIMEOUT
+            cache.set("%s.%s" % (self.prefix, key), (result, expires), timeout)
+        return result or None
+
+    def stats(self):
+        """
+        Hits and misses of the cache of the current process
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.local)}
+
+
+class GeoIPReader(object):
+    """
+    GeoIP city database shared by the whole process (GEOIP_PATH), opened on
+    the first lookup instead of on every request, with the recent lookups
+    kept in a LRU cache of GEOIP_CACHE_SIZE addresses. The database is
+    opened again after a fork, so workers don't share the file position.
+    """
+
+    def __init__(self, size):
+        self.cache = LRUCache(size)
+        self.lock = threading.Lock()
+        self.pid = None
+
+    def open(self):
+        from django.contrib.gis.utils import GeoIP
+        return GeoIP(cache=settings.GEOIP_CACHE_OPTION)
+
+    def city(self, ip):
+        """
+        Return the GeoIP city record (a dict) of the ip address, or None
+        """
+        if not ip:
+            return None
+        record = self.cache.get(ip)
+        if record is not None:
+            return record or None
+        self.lock.acquire()
+        try:
+            if self.pid != os.getpid():
+                self.geoip = self.open()
+                self.pid = os.getpid()
+            # the GeoIP C library isn't thread safe when reading from disk
+            record = self.geoip.city(ip) or {}
+        finally:
+            self.lock.release()
+        self.cache.set(ip, record)
+        return record or None
+
+
+def get_geocoder():
+    if settings.GEODATA_BOUNDARIES and is_compiled(settings.GEODATA_BOUNDARIES):
+        geocoder = MappedGeocoder(settings.GEODATA_BOUNDARIES)
+    elif settings.GEODATA_BOUNDARIES:
+        geocoder = BoundariesGeocoder(settings.GEODATA_BOUNDARIES,
+                                      settings.GEODATA_COUNTRY_PROPERTY, settings.GEODATA_REGION_PROPERTY)
+    else:
+        geocoder = GeonamesGeocoder()
+    return CachedGeocoder(geocoder)
+
+def is_compiled(filename):
+    """
+    Whether the boundaries file was compiled by compile_boundaries()
+    """
+    try:
+        f = open(filename, 'rb')
+    except IOError:
+        # reported on the first lookup
+        return False
+    try:
+        return f.read(len(MAGIC)) == MAGIC
+    finally:
+        f.close()
+
+geocoder = get_geocoder()
+
+
+def lookup(lat, lng):
+    """
+    Return a dict with the country code and the region of the coordinates,
+    or None if unknown
+    """
+    return geocoder.lookup(lat, lng)
+
+
+geoip = GeoIPReader(settings.GEOIP_CACHE_SIZE)
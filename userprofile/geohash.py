@@ -0,0 +1,98 @@
+"""
+Geohashes of the profile coordinates: the hash of a point starts with the
+hashes of every bigger cell containing it, so the profiles inside a cell are
+found with an indexed range query on the hash column
+"""
+import math
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+# mean radius of the earth, and length of a degree of latitude, in km
+EARTH_RADIUS = 6371.0
+DEGREE_LENGTH = math.pi * EARTH_RADIUS / 180
+
+PRECISION = 12
+
+
+def encode(lat, lng, precision=PRECISION):
+    lat_interval = [-90.0, 90.0]
+    lng_interval = [-180.0, 180.0]
+    chars = []
+    bits = value = 0
+    even = True
+    while len(chars) < precision:
+        # even bits split the longitude, odd bits the latitude
+        if even:
+            interval, coordinate = lng_interval, lng
+        else:
+            interval, coordinate = lat_interval, lat
+        middle = (interval[0] + interval[1]) / 2
+        if coordinate >= middle:
+            value = value << 1 | 1
+            interval[0] = middle
+        else:
+            value = value << 1
+            interval[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(BASE32[value])
+            bits = value = 0
+    return ''.join(chars)
+
+
+def cell_size(precision):
+    """
+    Height and width, in degrees, of the cells of the given precision
+    """
+    lng_bits = (5 * precision + 1) / 2
+    lat_bits = 5 * precision / 2
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lng_bits
+
+
+def cover(lat, lng, radius):
+    """
+    Return the hashes of the cells covering the bounding box of the circle
+    of radius km around the point, using the smallest cells bigger than the
+    radius (so at most 3x3 cells), or None if the circle is too big
+    """
+    dlat = radius / DEGREE_LENGTH
+    # widest longitude span of the circle, every longitude around the poles
+    angle = math.sin(radius / EARTH_RADIUS)
+    if angle < math.cos(math.radians(lat)) and abs(lat) + dlat < 90:
+        dlng = math.degrees(math.asin(angle / math.cos(math.radians(lat))))
+    else:
+        dlng = 180.0
+    for precision in range(PRECISION, 0, -1):
+        height, width = cell_size(precision)
+        if height >= dlat and width >= dlng:
+            break
+    else:
+        return None
+
+    lat_min, lat_max = max(lat - dlat, -90.0), min(lat + dlat, 90.0)
+    lng_min, lng_max = lng - min(dlng, 180.0), lng + min(dlng, 180.0)
+    cells = set()
+    y = lat_min
+    while True:
+        x = lng_min
+        while True:
+            # longitudes beyond the antimeridian wrap around
+            cells.add(encode(y, (x + 180.0) % 360.0 - 180.0, precision))
+            if x >= lng_max:
+                break
+            x = min(x + width, lng_max)
+        if y >= lat_max:
+            break
+        y = min(y + height, lat_max)
+    return cells
+
+
+def distance(lat1, lng1, lat2, lng2):
+    """
+    Great circle distance in km between two points (haversine formula)
+    """
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
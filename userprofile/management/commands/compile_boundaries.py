@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from userprofile import geodata
+from userprofile.settings import GEODATA_COUNTRY_PROPERTY, GEODATA_REGION_PROPERTY
+import os
+import time
+
+
+class Command(BaseCommand):
+    help = "Compile a GeoJSON boundaries file into the memory mapped file used by GEODATA_BOUNDARIES."
+    args = '<boundaries.geojson> <output file>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--cell-size', dest='cell_size', type='float', default=0.25,
+            help='Degrees of the cells of the index, dividing 180 (default: 0.25)'),
+        make_option('--country-property', dest='country_property', default=GEODATA_COUNTRY_PROPERTY,
+            help='Property of the features holding the ISO country code (default: GEODATA_COUNTRY_PROPERTY)'),
+        make_option('--region-property', dest='region_property', default=GEODATA_REGION_PROPERTY,
+            help='Property of the features holding the region name (default: GEODATA_REGION_PROPERTY)'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError("Usage: manage.py compile_boundaries %s" % self.args)
+        source, filename = args
+        if not os.path.isfile(source):
+            raise CommandError("%s doesn't exist" % source)
+        verbosity = int(options.get('verbosity', 1))
+
+        started = time.time()
+        geocoder = geodata.BoundariesGeocoder(source, options['country_property'], options['region_property'])
+        # written aside and renamed, so running processes keep their mapping
+        temporary = filename + '.tmp'
+        try:
+            stats = geodata.compile_boundaries(geocoder, temporary, options['cell_size'])
+            os.rename(temporary, filename)
+        except ValueError, e:
+            raise CommandError(str(e))
+        finally:
+            if os.path.exists(temporary):
+                os.unlink(temporary)
+        if verbosity:
+            self.stdout.write("%d polygons and %d edges compiled in %.1fs, %d of %d cells on borders, %d KB\n" % \
+                              (stats['polygons'], stats['edges'], time.time() - started, stats['border cells'],
+                               stats['cells'], os.path.getsize(filename) / 2 ** 10))
@@ -0,0 +1,12 @@
+from django.core.management.base import NoArgsCommand
+from userprofile.models import CountryCount
+
+
+class Command(NoArgsCommand):
+    help = "Count again the profiles of every country, for the country directory."
+
+    def handle_noargs(self, **options):
+        CountryCount.objects.rebuild()
+        if int(options.get('verbosity', 1)):
+            counts = CountryCount.objects.get_counts()
+            self.stdout.write("%d profiles in %d countries\n" % (sum(counts.values()), len(counts)))
@@ -0,0 +1,110 @@
+from django.core.management.base import CommandError, NoArgsCommand
+from django.db import connection
+from optparse import make_option
+from userprofile.models import Avatar
+from userprofile.settings import AVATAR_SIZES
+import datetime
+import multiprocessing
+import os
+import time
+
+
+def regenerate(args):
+    """
+    Worker of the process pool: regenerate the thumbnails of an avatar
+    """
+    pk, name, sizes = args
+    try:
+        Avatar(pk=pk, image=name, valid=True).regenerate_resized_images(sizes)
+    except Exception, e:
+        return pk, name, "%s: %s" % (e.__class__.__name__, e)
+    return pk, name, None
+
+
+class Command(NoArgsCommand):
+    help = "Regenerate the thumbnails of every valid avatar, in parallel."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--sizes', dest='sizes', default=None,
+            help='Comma separated list of sizes to regenerate (default: all of AVATAR_SIZES)'),
+        make_option('--since', dest='since', default=None,
+            help='Only avatars uploaded on or after this date (YYYY-MM-DD)'),
+        make_option('--processes', dest='processes', type='int', default=multiprocessing.cpu_count(),
+            help='Number of worker processes (default: one per CPU)'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=500,
+            help='Number of avatars fetched from the database at once'),
+        make_option('--checkpoint', dest='checkpoint', default=None,
+            help='File where the last processed avatar id is stored, to resume an interrupted run'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='List the avatars which would be processed, without touching them'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        sizes = AVATAR_SIZES
+        if options['sizes']:
+            try:
+                sizes = [int(size) for size in options['sizes'].split(',')]
+            except ValueError:
+                raise CommandError("--sizes must be a comma separated list of integers")
+            unknown = [size for size in sizes if size not in AVATAR_SIZES]
+            if unknown:
+                raise CommandError("Sizes not in AVATAR_SIZES: %s" % ", ".join(map(str, unknown)))
+
+        avatars = Avatar.objects.filter(valid=True)
+        if options['since']:
+            try:
+                since = datetime.datetime.strptime(options['since'], "%Y-%m-%d")
+            except ValueError:
+                raise CommandError("--since must be a date as YYYY-MM-DD")
+            avatars = avatars.filter(date__gte=since)
+
+        checkpoint = options['checkpoint']
+        last_pk = 0
+        if checkpoint and os.path.exists(checkpoint):
+            last_pk = int(open(checkpoint).read().strip() or 0)
+            if verbosity:
+                self.stdout.write("Resuming after avatar #%d\n" % last_pk)
+
+        total = avatars.filter(pk__gt=last_pk).count()
+        if verbosity:
+            self.stdout.write("%d avatars to process\n" % total)
+        if options['dry_run']:
+            for pk, name in avatars.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'image').iterator():
+                self.stdout.write("#%d %s\n" % (pk, name))
+            return
+
+        # workers don't use the database, don't let them share the connection
+        connection.close()
+        pool = multiprocessing.Pool(options['processes'])
+        processed = failed = 0
+        started = time.time()
+        try:
+            while True:
+                chunk = list(avatars.filter(pk__gt=last_pk).order_by('pk') \
+                             .values_list('pk', 'image')[:options['chunk_size']])
+                if not chunk:
+                    break
+                # avatars sharing a file (AVATAR_CONTENT_ADDRESSED) are processed once
+                names, jobs = set(), []
+                for pk, name in chunk:
+                    if name not in names:
+                        names.add(name)
+                        jobs.append((pk, name, sizes))
+                for pk, name, error in pool.imap_unordered(regenerate, jobs):
+                    if error:
+                        failed += 1
+                        self.stderr.write("#%d %s: %s\n" % (pk, name, error))
+                processed += len(chunk)
+                last_pk = chunk[-1][0]
+                if checkpoint:
+                    open(checkpoint, 'w').write("%d\n" % last_pk)
+                if verbosity:
+                    elapsed = time.time() - started
+                    rate = processed / elapsed
+                    eta = datetime.timedelta(seconds=int((total - processed) / rate))
+                    self.stdout.write("%d/%d avatars, %d failed, %.1f avatars/s, ETA %s\n" % \
+                                      (processed, total, failed, rate, eta))
+        finally:
+            pool.close()
+            pool.join()
@@ -0,0 +1,33 @@
+from django.core.management.base import NoArgsCommand
+from optparse import make_option
+from userprofile.models import QueuedEmail
+import time
+
+
+class Command(NoArgsCommand):
+    help = "Send the emails of the outbox (EMAIL_OUTBOX) in batches over a single connection."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=100,
+            help='Number of emails sent over every connection (default: 100)'),
+        make_option('--loop', action='store_true', dest='loop', default=False,
+            help='Keep running, checking the outbox every --interval seconds'),
+        make_option('--interval', dest='interval', type='float', default=5,
+            help='Seconds to wait when the outbox is empty, with --loop (default: 5)'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        while True:
+            started = time.time()
+            stats = QueuedEmail.objects.send_queued(options['batch_size'])
+            if verbosity and (stats['sent'] or stats['failed']):
+                message = "%d emails sent, %d failed in %.2fs" % \
+                          (stats['sent'], stats['failed'], time.time() - started)
+                if stats['average_wait'] is not None:
+                    message += ", %.1fs in the outbox on average" % stats['average_wait']
+                self.stdout.write(message + "\n")
+            if not options['loop']:
+                break
+            if stats['sent'] + stats['failed'] < options['batch_size']:
+                time.sleep(options['interval'])
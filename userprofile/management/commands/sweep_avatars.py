@@ -0,0 +1,128 @@
+from django.core.management.base import CommandError, NoArgsCommand
+from optparse import make_option
+from userprofile.models import Avatar
+from userprofile.settings import DEFAULT_AVATAR, MEDIA_STORAGE, \
+    REMOVE_LOST_AVATAR
+import datetime
+import os.path
+import re
+import time
+
+# avatars/2011/Jan/01/name.96.jpg is a thumbnail of avatars/2011/Jan/01/name.*
+THUMBNAIL_RE = re.compile(r'^(?P<stem>.+)\.\d+\.\w+$')
+
+
+class Throttle(object):
+    """
+    Allow at most rate operations per second (no limit if rate is 0)
+    """
+    def __init__(self, rate):
+        self.interval = rate and 1.0 / rate
+        self.next = 0
+
+    def wait(self):
+        now = time.time()
+        if now < self.next:
+            time.sleep(self.next - now)
+        self.next = max(now, self.next) + self.interval
+
+
+def walk(storage, path):
+    """
+    Yield the names of every file under path, with one listdir() call per
+    directory
+    """
+    dirs, files = storage.listdir(path)
+    for name in files:
+        yield os.path.join(path, name)
+    for name in dirs:
+        for filename in walk(storage, os.path.join(path, name)):
+            yield filename
+
+
+class Command(NoArgsCommand):
+    help = "Delete the avatar files without an Avatar row, and the avatars whose image is lost."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--path', dest='path', default='avatars',
+            help='Directory of the storage holding the avatars (default: avatars)'),
+        make_option('--min-age', dest='min_age', type='int', default=24,
+            help='Only files and avatars older than this number of hours are swept (default: 24)'),
+        make_option('--rate', dest='rate', type='float', default=10,
+            help='Maximum number of deletions per second, 0 for no limit (default: 10)'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Only list what would be deleted'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        dry_run = options['dry_run']
+        if options['rate'] < 0:
+            raise CommandError("--rate can't be negative")
+        throttle = Throttle(options['rate'])
+        storage = MEDIA_STORAGE
+        path = options['path'].rstrip('/')
+        limit = datetime.datetime.now() - datetime.timedelta(hours=options['min_age'])
+
+        # The database is read after listing the storage: a file listed
+        # without its row was either orphaned or uploaded during the listing,
+        # and the later is spared by --min-age and a last check before
+        # deleting it
+        files = set(walk(storage, path))
+        names = set(Avatar.objects.values_list('image', flat=True).iterator())
+        stems = set(os.path.splitext(name)[0] for name in names)
+        stems.add(os.path.splitext(DEFAULT_AVATAR)[0])
+
+        orphans = 0
+        for filename in sorted(files):
+            if filename in names:
+                continue
+            match = THUMBNAIL_RE.match(filename)
+            if match and match.group('stem') in stems:
+                continue
+            if not self.is_old(storage, filename, limit):
+                continue
+            stem = match and match.group('stem') or os.path.splitext(filename)[0]
+            if Avatar.objects.filter(image__startswith=stem + '.').exists():
+                continue
+            orphans += 1
+            if verbosity > 1 or dry_run:
+                self.stdout.write("orphan file %s\n" % filename)
+            if not dry_run:
+                throttle.wait()
+                storage.delete(filename)
+
+        lost = 0
+        if REMOVE_LOST_AVATAR:
+            for avatar in Avatar.objects.filter(image__startswith=path + '/', date__lt=limit).iterator():
+                if avatar.image.name in files:
+                    continue
+                if not dry_run:
+                    throttle.wait()
+                # avatarchoose and avatarcrop give a new image to the row,
+                # maybe after the listing: check it again before deleting it
+                try:
+                    avatar = Avatar.objects.get(pk=avatar.pk)
+                except Avatar.DoesNotExist:
+                    continue
+                if storage.exists(avatar.image.name):
+                    continue
+                lost += 1
+                if verbosity > 1 or dry_run:
+                    self.stdout.write("lost avatar #%d %s\n" % (avatar.pk, avatar.image.name))
+                if not dry_run:
+                    Avatar.objects.delete_avatars([avatar], deferred=False)
+
+        if verbosity:
+            self.stdout.write("%d files listed, %d orphan files and %d lost avatars %s\n" % \
+                              (len(files), orphans, lost, dry_run and "found" or "deleted"))
+
+    def is_old(self, storage, filename, limit):
+        try:
+            return storage.modified_time(filename) < limit
+        except NotImplementedError:
+            # rely on the last database check only
+            return True
+        except (OSError, IOError):
+            # deleted since the listing
+            return False
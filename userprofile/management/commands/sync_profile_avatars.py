@@ -0,0 +1,26 @@
+from django.core.management.base import CommandError, NoArgsCommand
+from django.db.models import F
+from userprofile.models import Avatar, get_profile_model
+
+
+class Command(NoArgsCommand):
+    help = "Fill the denormalized avatar fields of the profiles from the Avatar table."
+
+    def handle_noargs(self, **options):
+        Profile = get_profile_model()
+        if Profile is None:
+            raise CommandError("AUTH_PROFILE_MODULE is not set")
+        verbosity = int(options.get('verbosity', 1))
+
+        updated = 0
+        for user_id, name in Avatar.objects.filter(valid=True).values_list('user', 'image').iterator():
+            updated += Profile.objects.filter(user=user_id).exclude(avatar_name=name) \
+                .update(avatar_name=name, avatar_version=F('avatar_version') + 1)
+
+        # profiles pointing to an avatar that isn't valid anymore
+        cleared = Profile.objects.exclude(avatar_name='') \
+            .exclude(user__in=Avatar.objects.filter(valid=True).values('user')) \
+            .update(avatar_name='', avatar_version=F('avatar_version') + 1)
+
+        if verbosity:
+            self.stdout.write("%d profiles updated, %d cleared\n" % (updated, cleared))
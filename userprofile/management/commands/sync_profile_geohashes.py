@@ -0,0 +1,28 @@
+from django.core.management.base import CommandError, NoArgsCommand
+from django.db.models import Q
+from userprofile import geohash
+from userprofile.models import get_profile_model
+
+
+class Command(NoArgsCommand):
+    help = "Fill the geohash field of the profiles from their coordinates."
+
+    def handle_noargs(self, **options):
+        Profile = get_profile_model()
+        if Profile is None:
+            raise CommandError("AUTH_PROFILE_MODULE is not set")
+        verbosity = int(options.get('verbosity', 1))
+
+        updated = 0
+        profiles = Profile.objects.filter(latitude__isnull=False, longitude__isnull=False)
+        for pk, lat, lng, current in profiles.values_list('pk', 'latitude', 'longitude', 'geohash').iterator():
+            value = geohash.encode(float(lat), float(lng))
+            if value != current:
+                updated += Profile.objects.filter(pk=pk).update(geohash=value)
+
+        cleared = Profile.objects.exclude(geohash='') \
+            .filter(Q(latitude__isnull=True) | Q(longitude__isnull=True)) \
+            .update(geohash='')
+
+        if verbosity:
+            self.stdout.write("%d profiles updated, %d cleared\n" % (updated, cleared))
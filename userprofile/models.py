@@ -3,24 +3,139 @@ from countries import CountryField
 from django.conf import settings as django_settings
 from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
-from django.core.files.base import ContentFile, File
+from django.core.cache import cache
+from django.core.files.base import File
 from django.core.files.storage import get_storage_class
-from django.core.mail import send_mail
+from django.core.mail import send_mail, get_connection, EmailMessage
 from django.core.urlresolvers import reverse
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count, F, Q
 from django.template import loader, Context
+from django.utils.crypto import salted_hmac, constant_time_compare
+from django.utils.encoding import smart_str
+from django.utils.http import int_to_base36, base36_to_int
 from django.utils.translation import ugettext_lazy as _
+from thumbnails import registry as thumbnails, workers as thumbnail_workers, \
+    modern_formats
+import base64
 import datetime
+import deletion
+import geohash
+import hashlib
+import logging
 import os.path
 import settings
+import tempfile
+import time
 try:
     from PIL import Image
 except ImportError:
     import Image
-try:
-    from cStringIO import StringIO
-except ImportError:
-    from StringIO import StringIO
+
+
+def get_profile_model():
+    """
+    Return the profile model (AUTH_PROFILE_MODULE), or None if not available
+    """
+    if not getattr(django_settings, 'AUTH_PROFILE_MODULE', None):
+        return None
+    app_label, model_name = django_settings.AUTH_PROFILE_MODULE.split('.')
+    return models.get_model(app_label, model_name)
+
+
+def open_image(f, size=None):
+    """
+    Open and decode an image file as RGB, returning the image and its
+    format; the file can be closed afterwards. If the image is going to be
+    shrunk to fit a size x size box, JPEGs are decoded directly at the
+    smallest scale (1/2, 1/4 or 1/8) still bigger than the box, so the full
+    resolution bitmap is never allocated.
+    """
+    image = Image.open(f)
+    img_format = image.format
+    if size and img_format == 'JPEG':
+        image.draft('RGB', (size, size))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    else:
+        image.load()
+    return image, img_format
+
+
+def encode_image(image, img_format, name):
+    """
+    Encode the image (with SAVE_IMG_PARAMS) into a spooled temporary file,
+    kept in memory up to AVATAR_SPOOL_MAX_SIZE bytes and on disk beyond
+    that, ready to be given to storage.save() without further copies. The
+    name is used to guess the format if img_format is None.
+    """
+    f = File(tempfile.SpooledTemporaryFile(max_size=settings.AVATAR_SPOOL_MAX_SIZE), name=name)
+    try:
+        image.save(f, img_format, **settings.SAVE_IMG_PARAMS.get(img_format, {}))
+    except:
+        f.seek(0)
+        f.truncate()
+        image.save(f, img_format)
+    f.size = f.tell()
+    f.seek(0)
+    return f
+
+
+def shrink_image(image, size):
+    """
+    Shrink the image in place to fit in a size x size box
+    """
+    if hasattr(image, 'reduce'):
+        # reduce by an integer factor (cheap box filter) before resampling
+        image.thumbnail((size, size), Image.ANTIALIAS, reducing_gap=2.0)
+    else:
+        image.thumbnail((size, size), Image.ANTIALIAS)
+
+
+def resize_image(image, size):
+    """
+    Fit the image in a size x size box (or enlarge it to that box, if
+    CAN_ENLARGE_AVATAR is set). Shrinking is done in place.
+    """
+    if not settings.CAN_ENLARGE_AVATAR or (image.size[0] > size or image.size[1] > size or not hasattr(image, 'resize')):
+        shrink_image(image, size)
+    else:
+        image = image.resize((size, size), Image.BICUBIC)
+    return image
+
+
+class ProfileManager(models.Manager):
+    """
+    Profile manager
+    """
+    def near(self, lat, lng, radius_km, limit=None):
+        """
+        Return the profiles within radius_km of the coordinates, nearest
+        first, with their distance (km) on the distance attribute. The
+        candidates are found with indexed range queries on the geohash of
+        the cells around the point, and then ranked by their exact distance.
+        """
+        lat, lng = float(lat), float(lng)
+        profiles = self.get_query_set().exclude(geohash='')
+        cells = geohash.cover(lat, lng, radius_km)
+        if cells is not None:
+            query = Q()
+            # '~' sorts after every geohash character
+            for cell in cells:
+                query |= Q(geohash__gte=cell, geohash__lt=cell + '~')
+            profiles = profiles.filter(query)
+        dlat = radius_km / geohash.DEGREE_LENGTH
+        profiles = profiles.filter(latitude__gte=str(lat - dlat), latitude__lte=str(lat + dlat))
+
+        found = []
+        for profile in profiles:
+            profile.distance = geohash.distance(lat, lng, float(profile.latitude), float(profile.longitude))
+            if profile.distance <= radius_km:
+                found.append(profile)
+        found.sort(key=lambda profile: profile.distance)
+        if limit is not None:
+            found = found[:limit]
+        return found
 
 
 class BaseProfile(models.Model):
@@ -29,18 +144,48 @@ class BaseProfile(models.Model):
     """
     user = models.ForeignKey(User, unique=True, verbose_name=_('user'))
     creation_date = models.DateTimeField(_('creation date'), default=datetime.datetime.now)
-    country = CountryField(_('country'), null=True, blank=True)
+    country = CountryField(_('country'), null=True, blank=True, db_index=True)
     latitude = models.DecimalField(_('latitude'), max_digits=10, decimal_places=6, \
                                    blank=True, null=True)
     longitude = models.DecimalField(_('longitude'), max_digits=10, decimal_places=6, \
                                     blank=True, null=True)
     location = models.CharField(_('location'), max_length=255, blank=True, null=True)
+    # denormalized pointer to the current valid avatar, kept in sync by
+    # Avatar.save() and Avatar.delete()
+    avatar_name = models.CharField(_('avatar'), max_length=255, blank=True, editable=False)
+    avatar_version = models.PositiveIntegerField(_('avatar version'), default=0, editable=False)
+    # geohash of the coordinates, see ProfileManager.near()
+    geohash = models.CharField(_('geohash'), max_length=geohash.PRECISION, blank=True, \
+                               db_index=True, editable=False)
+
+    objects = ProfileManager()
 
     class Meta:
         abstract = True
 
+    def save(self, *args, **kwargs):
+        if self.latitude is not None and self.longitude is not None:
+            self.geohash = geohash.encode(float(self.latitude), float(self.longitude))
+        else:
+            self.geohash = ''
+        if not self.pk and not self.avatar_name:
+            try:
+                self.avatar_name = Avatar.objects.get(user=self.user_id, valid=True).image.name
+            except Avatar.DoesNotExist:
+                pass
+        super(BaseProfile, self).save(*args, **kwargs)
+
     def has_avatar(self):
-        return Avatar.objects.filter(user=self.user, valid=True).count()
+        return bool(self.avatar_name)
+
+    def get_avatar(self):
+        """
+        Return the current Avatar of the user, built from the denormalized
+        fields without querying the Avatar table
+        """
+        if not self.avatar_name:
+            return Avatar.objects.get_default_avatar()
+        return Avatar(user_id=self.user_id, image=self.avatar_name, valid=True)
 
     def __unicode__(self):
         return _("%s's profile") % self.user
@@ -49,6 +194,74 @@ class BaseProfile(models.Model):
         return reverse("profile_public", args=[self.user])
 
 
+class CountryCountManager(models.Manager):
+    """
+    Manager of the number of profiles per country
+    """
+    cache_key = 'userprofile.country_counts'
+
+    def change(self, old, new):
+        """
+        Move a profile from the old country to the new one, any of them may
+        be empty (new or deleted profiles)
+        """
+        if old == new:
+            return
+        if old:
+            self.filter(country=old, count__gt=0).update(count=F('count') - 1)
+        if new:
+            if not self.filter(country=new).update(count=F('count') + 1):
+                self.get_or_create(country=new)
+                self.filter(country=new).update(count=F('count') + 1)
+        cache.delete(self.cache_key)
+
+    def get_counts(self):
+        """
+        Return a dict of country code => number of profiles, from the cache
+        if available
+        """
+        counts = cache.get(self.cache_key)
+        if counts is None:
+            counts = dict(self.filter(count__gt=0).values_list('country', 'count'))
+            cache.set(self.cache_key, counts, settings.COUNTRY_COUNTS_CACHE_TIMEOUT)
+        return counts
+
+    @transaction.commit_on_success
+    def rebuild(self):
+        """
+        Count again the profiles of every country
+        """
+        Profile = get_profile_model()
+        self.all().delete()
+        if Profile is not None:
+            counts = Profile.objects.exclude(country__isnull=True).exclude(country='') \
+                .values('country').annotate(total=Count('pk')).order_by()
+            for row in counts:
+                self.create(country=row['country'], count=row['total'])
+        cache.delete(self.cache_key)
+
+
+class CountryCount(models.Model):
+    """
+    Number of profiles of a country, kept up to date by the location and
+    delete views (and rebuilt by "manage.py rebuild_country_counts")
+    """
+    country = CountryField(_('country'), primary_key=True)
+    count = models.PositiveIntegerField(_('members'), default=0)
+
+    objects = CountryCountManager()
+
+    class Meta:
+        verbose_name = _('country count')
+        verbose_name_plural = _('country counts')
+
+    def __unicode__(self):
+        return u"%s: %d" % (self.get_country_display(), self.count)
+
+
+# per process cache of the default Avatar instance, see get_default_avatar()
+_default_avatar = {}
+
 class AvatarManager(models.Manager):
 
     def get_for_user(self, user):
@@ -57,19 +270,165 @@ class AvatarManager(models.Manager):
         elif user.is_anonymous():
             return self.get_default_avatar()
 
+        # the profile, if already loaded, knows the current avatar
+        profile = getattr(user, '_profile_cache', None)
+        if isinstance(profile, BaseProfile):
+            return profile.get_avatar()
+
         try:
             return self.get_query_set().get(user=user, valid=True)
         except Avatar.DoesNotExist:
             return self.get_default_avatar()
 
+    def get_for_users(self, users):
+        """
+        Return a dict of user id => Avatar for every user (or profile) on the
+        list, resolving all the valid avatars with a single query. Profiles
+        (given or already loaded on the user) know their avatar, or that there
+        isn't any, so they don't need any query. Users without a valid avatar
+        share the same default Avatar instance.
+        """
+        users, profiles = list(users), []
+        for i, user in enumerate(users):
+            if isinstance(user, BaseProfile):
+                profiles.append(user)
+                users[i] = user.user
+            elif isinstance(getattr(user, '_profile_cache', None), BaseProfile):
+                profiles.append(user._profile_cache)
+        lookup = set()
+        for user in users:
+            if user.is_anonymous():
+                continue
+            if not user.is_active and settings.DEFAULT_AVATAR_FOR_INACTIVES_USER:
+                continue
+            lookup.add(user.pk)
+
+        avatars = {}
+        for profile in profiles:
+            if profile.user_id in lookup:
+                if profile.avatar_name:
+                    avatars[profile.user_id] = profile.get_avatar()
+                lookup.remove(profile.user_id)
+        if lookup:
+            for avatar in self.get_query_set().filter(user__in=lookup, valid=True):
+                avatars[avatar.user_id] = avatar
+
+        default = None
+        for user in users:
+            if user.pk not in avatars:
+                if default is None:
+                    default = self.get_default_avatar()
+                avatars[user.pk] = default
+        return avatars
+
+    def urls_for_users(self, users, size, img_format=None):
+        """
+        Return a dict of user id => avatar url of the given size for every
+        user on the list. See get_for_users().
+        """
+        return self.get_urls(self.get_for_users(users), size, img_format)
+
+    def get_urls(self, avatars, size, img_format=None):
+        """
+        Turn a dict of user id => Avatar (as returned by get_for_users())
+        into a dict of user id => url, resolving shared instances only once.
+        """
+        if img_format and img_format not in modern_formats():
+            img_format = None
+        unique = dict((id(avatar), avatar) for avatar in avatars.values())
+        resolved = {}
+        for key, avatar in unique.items():
+            if (size, img_format) in (getattr(avatar, 'resized_urls', None) or {}):
+                resolved[key] = avatar.resized_urls[(size, img_format)]
+                del unique[key]
+        known = thumbnails.exists_many([(avatar.image.name, size) for avatar in unique.values()], img_format)
+        for key, avatar in unique.items():
+            if (avatar.image.name, size) in known:
+                resolved[key] = avatar.image.storage.url(avatar.get_resized_image_filename(size, img_format=img_format))
+            else:
+                resolved[key] = avatar.get_resized_image_url(size, img_format)
+        return dict((user_id, resolved[id(avatar)]) for user_id, avatar in avatars.items())
+
+    def delete_files(self, names, deferred=None):
+        """
+        Delete files from the avatars storage, in parallel or in a single
+        batch (see deletion.py). With deferred (AVATAR_DEFERRED_DELETE if
+        None) they are deleted after the response.
+        """
+        if deferred is None:
+            deferred = settings.AVATAR_DEFERRED_DELETE
+        storage = self.model._meta.get_field('image').storage
+        names = list(names)
+        if deferred:
+            deletion.deferred.submit(deletion.delete_files, storage, names)
+        else:
+            deletion.delete_files(storage, names)
+
+    def delete_images(self, avatars, deferred=None):
+        """
+        Delete the source images of the given avatars and their thumbnails
+        with a single delete_files() call, except the images used by some
+        avatar when the files are deleted. With deferred
+        (AVATAR_DEFERRED_DELETE if None) that's checked after the response,
+        so an image used again meanwhile (see save_image) is kept.
+        """
+        avatars = [avatar for avatar in avatars \
+                   if avatar.image.name and avatar.image.name != settings.DEFAULT_AVATAR]
+        if not avatars:
+            return
+        if deferred is None:
+            deferred = settings.AVATAR_DEFERRED_DELETE
+        if deferred:
+            deletion.deferred.submit(self.delete_unused_images, avatars)
+        else:
+            self.delete_unused_images(avatars)
+
+    def delete_unused_images(self, avatars):
+        names = set(avatar.image.name for avatar in avatars)
+        names -= set(self.get_query_set().filter(image__in=names).values_list('image', flat=True))
+        files = []
+        for avatar in avatars:
+            if avatar.image.name in names:
+                names.remove(avatar.image.name)
+                files.extend(avatar.get_file_names())
+        self.delete_files(files, deferred=False)
+
+    def delete_avatars(self, avatars, deferred=None, images=True):
+        """
+        Delete a list (or queryset) of avatars with a single query, and their
+        files with delete_images() unless images is False. Return the list
+        of deleted avatars.
+        """
+        avatars = list(avatars)
+        if not avatars:
+            return avatars
+        for avatar in avatars:
+            if avatar.valid:
+                avatar.update_profile('', current_name=avatar.image.name)
+        self.get_query_set().filter(pk__in=[avatar.pk for avatar in avatars]).delete()
+        if images:
+            self.delete_images(avatars, deferred)
+        return avatars
+
     def get_default_avatar(self):
-        """Return Avatar model instance with default avatar image from static files storage"""
-        static_storage = get_storage_class(django_settings.STATICFILES_STORAGE)()
-        image = static_storage.open(settings.DEFAULT_AVATAR)
-        avatar = Avatar(image=image, valid=True)
-        avatar.image.storage = static_storage
-        avatar.image.name = settings.DEFAULT_AVATAR
-        return avatar
+        """
+        Return Avatar model instance with default avatar image from static
+        files storage. The instance is built once per process (and again if
+        the DEFAULT_AVATAR or STATICFILES_STORAGE settings change) with the
+        urls of every size and format already resolved, so treat it as read
+        only.
+        """
+        default_avatar = getattr(django_settings, 'DEFAULT_AVATAR', settings.DEFAULT_AVATAR)
+        formats = [None] + modern_formats()
+        key = (django_settings.STATICFILES_STORAGE, default_avatar, settings.AVATAR_SIZES, formats)
+        if _default_avatar.get('key') != key:
+            avatar = Avatar(image=default_avatar, valid=True)
+            avatar.is_default = True
+            avatar.image.storage = get_storage_class(django_settings.STATICFILES_STORAGE)()
+            avatar.resized_urls = dict(((size, img_format), avatar.get_resized_image_url(size, img_format)) \
+                                       for size in settings.AVATAR_SIZES for img_format in formats)
+            _default_avatar.update(key=key, avatar=avatar)
+        return _default_avatar['avatar']
 
 
 class Avatar(models.Model):
@@ -83,6 +442,9 @@ class Avatar(models.Model):
 
     objects = AvatarManager()
 
+    # True on the shared instance returned by AvatarManager.get_default_avatar()
+    is_default = False
+
     class Meta:
         unique_together = (('user', 'valid'),)
         verbose_name = _('avatar')
@@ -91,9 +453,11 @@ class Avatar(models.Model):
     def __unicode__(self):
         return _("%s's Avatar") % self.user
 
-    def get_resized_image_filename(self, size=None, sizes=None):
+    def get_resized_image_filename(self, size=None, sizes=None, img_format=None):
         base, filename = os.path.split(self.image.name)
         name, extension = os.path.splitext(filename)
+        if img_format:
+            extension = ".%s" % img_format.lower()
         if size is None:
             if sizes is not None:
                 return [os.path.join(base, "%s.%s%s" % (name, size, extension)) for size in sizes]
@@ -102,47 +466,302 @@ class Avatar(models.Model):
         else:
             return os.path.join(base, "%s.%s%s" % (name, size, extension))
 
-    def get_resized_image_url(self, size):
-        resized_filename = self.get_resized_image_filename(size)
+    def get_resized_image_url(self, size, img_format=None):
+        """
+        Return the url of the thumbnail of the given size, in the source
+        format or in one of AVATAR_MODERN_FORMATS (img_format), generating
+        it if needed
+        """
+        if img_format and img_format not in modern_formats():
+            img_format = None
+        resized_urls = getattr(self, 'resized_urls', None)
+        if resized_urls and (size, img_format) in resized_urls:
+            return resized_urls[(size, img_format)]
+        resized_filename = self.get_resized_image_filename(size, img_format=img_format)
+        if thumbnails.exists(self.image.name, size, img_format):
+            return self.image.storage.url(resized_filename)
+        if settings.AVATAR_ASYNC_THUMBNAILS and not self.is_default:
+            thumbnail_workers.submit(self, size, img_format)
+            return Avatar.objects.get_default_avatar().get_resized_image_url(size, img_format)
         if not self.image.storage.exists(resized_filename):
-            if not self.image.storage.exists(self.image.name) and settings.REMOVE_LOST_AVATAR:
-                self.delete()
-                return Avatar.objects.get_default_avatar().get_resized_image_url(size)
-            thumb = Image.open(self.image)
-            if thumb.mode != 'RGB':
-                thumb = thumb.convert('RGB')
-            img_format = thumb.format
-            if not settings.CAN_ENLARGE_AVATAR or (thumb.size[0] > size or thumb.size[1] > size or not hasattr(thumb, 'resize')):
-                thumb.thumbnail((size, size), Image.ANTIALIAS)
-            else:
-                thumb = thumb.resize((size, size), Image.BICUBIC)
-            f = File(StringIO(), name=resized_filename)
             try:
-                thumb.save(f, img_format, **settings.SAVE_IMG_PARAMS.get(img_format, {}))
-            except:
-                thumb.save(f, img_format)
-            f.seek(0)
-            self.image.storage.save(resized_filename, ContentFile(f.read()))
+                self.generate_resized_image(size, [img_format])
+            except (IOError, OSError):
+                if self.is_default:
+                    raise
+                # lost source image, removed offline by "manage.py sweep_avatars"
+                return Avatar.objects.get_default_avatar().get_resized_image_url(size, img_format)
+        else:
+            thumbnails.add(self.image.name, size, img_format)
         return self.image.storage.url(resized_filename)
 
-    def delete_avatar_thumbs(self):
+    def generate_resized_image(self, size, formats=None):
+        f = self.image.storage.open(self.image.name)
+        try:
+            thumb, img_format = open_image(f, size)
+            self.save_resized_image(resize_image(thumb, size), size, img_format, formats)
+        finally:
+            f.close()
+
+    def save_resized_image(self, thumb, size, img_format, formats=None):
+        """
+        Save a thumbnail in the source format (img_format) and in every
+        available modern format, or only in the given formats (None standing
+        for the source format)
+        """
+        if formats is None:
+            formats = [None] + modern_formats()
+        for variant in formats:
+            resized_filename = self.get_resized_image_filename(size, img_format=variant)
+            f = encode_image(thumb, variant or img_format, resized_filename)
+            try:
+                self.image.storage.save(resized_filename, f)
+            finally:
+                f.close()
+        thumbnails.add_many(self.image.name, [size], formats)
+
+    def create_resized_images(self, image, img_format=None, sizes=None):
+        """
+        Generate and save every size of the avatar from an already decoded
+        image, each one downscaled from the previous (bigger) one
+        """
+        if img_format is None:
+            Image.init()
+            img_format = Image.EXTENSION.get(os.path.splitext(self.image.name)[1].lower())
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        else:
+            image = image.copy()
+        sizes = sorted(sizes or settings.AVATAR_SIZES, reverse=True)
+        previous = image
+        for size in sizes:
+            if max(previous.size) < size:
+                # enlarged sizes are always taken from the source image
+                previous = image
+            previous = resize_image(previous, size)
+            self.save_resized_image(previous, size, img_format)
+
+    def regenerate_resized_images(self, sizes=None):
+        """
+        Delete and generate again the thumbnails of the given sizes (every
+        size of AVATAR_SIZES if None), from a single decode of the source.
+        The thumbnails are only deleted once the source has been decoded.
+        """
+        sizes = sizes or settings.AVATAR_SIZES
+        f = self.image.storage.open(self.image.name)
+        try:
+            image, img_format = open_image(f, max(sizes))
+        finally:
+            f.close()
+        self.delete_avatar_thumbs(sizes)
+        self.create_resized_images(image, img_format, sizes)
+
+    def get_thumbnail_names(self, sizes=None):
+        """
+        Names of the thumbnails of the given sizes (every size of
+        AVATAR_SIZES if None) in every format, forgetting them on the
+        thumbnails registry
+        """
+        sizes = sizes or settings.AVATAR_SIZES
+        formats = [None] + modern_formats()
+        thumbnails.discard(self.image.name, sizes, formats)
+        names = []
+        for img_format in formats:
+            names.extend(self.get_resized_image_filename(sizes=sizes, img_format=img_format))
+        return names
+
+    def get_file_names(self):
+        """
+        Names of the source image and all its thumbnails, see
+        get_thumbnail_names()
+        """
+        return [self.image.name] + self.get_thumbnail_names()
+
+    def delete_avatar_thumbs(self, sizes=None):
         if self.image.name is None or self.image.name == settings.DEFAULT_AVATAR:
             return
-        for filename in self.get_resized_image_filename(sizes=settings.AVATAR_SIZES):
-            try:
-                self.image.storage.delete(filename)
-            except:
-                pass
+        # never deferred: they may be generated again right away
+        Avatar.objects.delete_files(self.get_thumbnail_names(sizes), deferred=False)
+
+    def update_profile(self, avatar_name, current_name=None):
+        """
+        Point the denormalized avatar fields of the user profile to
+        avatar_name, if they currently point to current_name (any avatar if
+        None)
+        """
+        Profile = get_profile_model()
+        if Profile is None:
+            return
+        profiles = Profile.objects.filter(user=self.user_id)
+        if current_name is not None:
+            profiles = profiles.filter(avatar_name=current_name)
+        profiles.update(avatar_name=avatar_name, avatar_version=F('avatar_version') + 1)
+
+    def save(self, *args, **kwargs):
+        super(Avatar, self).save(*args, **kwargs)
+        if self.valid:
+            self.update_profile(self.image.name)
+
+    def save_image(self, name, content, digest=None):
+        """
+        Store the avatar source image without saving the model. With
+        AVATAR_CONTENT_ADDRESSED the file is named after the hash of its
+        content (or the given digest, if already known) and identical images
+        share the same file. Return False if the file already existed (so
+        its thumbnails may exist too).
+        """
+        if not settings.AVATAR_CONTENT_ADDRESSED:
+            self.image.save(name, content, save=False)
+            return True
+        if digest is None:
+            digest = hashlib.sha1()
+            for chunk in content.chunks():
+                digest.update(chunk)
+            digest = digest.hexdigest()
+        extension = os.path.splitext(name)[1]
+        name = "avatars/%s/%s%s" % (digest[:2], digest, extension)
+        if self.image.storage.exists(name):
+            self.image.name = name
+            return False
+        content.seek(0)
+        self.image.name = self.image.storage.save(name, content)
+        return True
+
+    def replace_image(self, name, content, digest=None):
+        """
+        Store a new source image (see save_image) and save the model, then
+        delete the previous image and its thumbnails. The new image is saved
+        first, so the previous files can be deleted after the response
+        without clashing with the new ones. Return what save_image returned.
+        """
+        previous = Avatar(pk=self.pk, user_id=self.user_id, image=self.image.name)
+        created = self.save_image(name, content, digest)
+        self.save()
+        if previous.image.name != self.image.name:
+            previous.delete_image()
+        return created
+
+    def delete_image(self, deferred=None):
+        """
+        Delete the source image and its thumbnails, unless an avatar uses
+        them (see save_image), so the avatar shouldn't point to it anymore
+        """
+        Avatar.objects.delete_images([self], deferred)
 
     def delete(self):
-        if self.image.name != settings.DEFAULT_AVATAR:
-            self.delete_avatar_thumbs()
-            # deleting avatar source
-            try:
-                self.image.storage.delete(self.image.name)
-            except:
-                pass
-        super(Avatar, self).delete()
+        Avatar.objects.delete_avatars([self])
+
+
+logger = logging.getLogger('userprofile.models')
+
+
+def close_connection(connection):
+    """
+    Close the connection of an email backend, if open. The SMTP backend
+    fails to close a connection that isn't open, or that is broken.
+    """
+    if getattr(connection, 'connection', True) is None:
+        return
+    try:
+        connection.close()
+    except Exception:
+        logger.warning("Can't close the email connection", exc_info=True)
+
+
+class QueuedEmailManager(models.Manager):
+    """
+    Outbox of the emails sent by the application
+    """
+    def enqueue(self, subject, body, recipient_list, from_email=None):
+        """
+        Queue an email, to be sent by send_queued(), or send it right away
+        if EMAIL_OUTBOX is False
+        """
+        if not settings.EMAIL_OUTBOX:
+            send_mail(subject=subject, message=body, from_email=from_email, recipient_list=recipient_list)
+            return None
+        return self.create(subject=subject, body=body, from_email=from_email or '',
+                           recipients='\n'.join(recipient_list))
+
+    def send_queued(self, batch_size=100, connection=None):
+        """
+        Send a batch of the due emails over a single connection. Failed
+        emails are retried later, waiting twice as long after every attempt
+        (EMAIL_OUTBOX_RETRY_DELAY seconds the first time), up to
+        EMAIL_OUTBOX_MAX_ATTEMPTS times. Return the number of sent and
+        failed emails, and the average seconds they waited in the queue.
+        """
+        now = datetime.datetime.now()
+        due = self.filter(next_attempt__lte=now, attempts__lt=settings.EMAIL_OUTBOX_MAX_ATTEMPTS) \
+            .order_by('next_attempt')[:batch_size]
+        stats = {'sent': 0, 'failed': 0, 'average_wait': None}
+        if not due:
+            return stats
+        if connection is None:
+            connection = get_connection()
+        lease = now + datetime.timedelta(seconds=settings.EMAIL_OUTBOX_RETRY_DELAY)
+        wait = 0.0
+        try:
+            for email in due:
+                # claim the email, so concurrent workers don't send it twice
+                if not self.filter(pk=email.pk, next_attempt=email.next_attempt).update(next_attempt=lease):
+                    continue
+                message = EmailMessage(email.subject, email.body, email.from_email or None,
+                                       email.recipients.split('\n'), connection=connection)
+                try:
+                    # the backends only keep the connection for the next
+                    # messages if it was opened before send_messages()
+                    connection.open()
+                    connection.send_messages([message])
+                except Exception, e:
+                    # the connection may be broken, it's opened again on the next email
+                    close_connection(connection)
+                    email.failed(e)
+                    stats['failed'] += 1
+                else:
+                    delta = datetime.datetime.now() - email.created
+                    wait += delta.days * 86400 + delta.seconds
+                    email.delete()
+                    stats['sent'] += 1
+        finally:
+            close_connection(connection)
+        if stats['sent']:
+            stats['average_wait'] = wait / stats['sent']
+        return stats
+
+
+class QueuedEmail(models.Model):
+    """
+    Email waiting on the outbox (EMAIL_OUTBOX), see "manage.py send_queued_email"
+    """
+    subject = models.CharField(_('subject'), max_length=255)
+    body = models.TextField(_('body'))
+    from_email = models.CharField(_('from'), max_length=255, blank=True)
+    recipients = models.TextField(_('recipients'))
+    created = models.DateTimeField(_('created'), auto_now_add=True)
+    attempts = models.PositiveIntegerField(_('attempts'), default=0)
+    next_attempt = models.DateTimeField(_('next attempt'), default=datetime.datetime.now, db_index=True)
+    last_error = models.TextField(_('last error'), blank=True)
+
+    objects = QueuedEmailManager()
+
+    class Meta:
+        verbose_name = _('queued email')
+        verbose_name_plural = _('queued emails')
+
+    def __unicode__(self):
+        return u"%s: %s" % (self.recipients.replace('\n', ', '), self.subject)
+
+    def failed(self, error):
+        """
+        Record a failed attempt and schedule the next one
+        """
+        self.attempts += 1
+        delay = settings.EMAIL_OUTBOX_RETRY_DELAY * 2 ** (self.attempts - 1)
+        self.next_attempt = datetime.datetime.now() + datetime.timedelta(seconds=delay)
+        self.last_error = "%s: %s" % (error.__class__.__name__, error)
+        self.save()
+        logger.warning("Can't send the email %d (attempt %d): %s" % (self.pk, self.attempts, self.last_error))
 
 
 class EmailValidationManager(models.Manager):
@@ -150,6 +769,9 @@ class EmailValidationManager(models.Manager):
     Email validation manager
     """
     def verify(self, key):
+        if '-' in key:
+            # random keys never contain dashes
+            return self.verify_token(key)
         try:
             verify = self.get(key=key)
             if not verify.is_expired():
@@ -167,6 +789,102 @@ class EmailValidationManager(models.Manager):
         except:
             return False
 
+    key_salt = 'userprofile.models.EmailValidationManager'
+
+    def sign(self, user, email, timestamp, flag):
+        """
+        Signature of a key, covering the state of the user that a validation
+        changes (email, password, active, and the last login of activation
+        keys), so used or outdated keys stop being valid
+        """
+        last_login = None
+        if flag == '1':
+            # without microseconds, which some databases don't store. Email
+            # changes don't sign it, the user may log in before using the key
+            last_login = user.last_login and user.last_login.replace(microsecond=0)
+        value = u"%s:%s:%s:%s:%s:%s:%s:%s" % (user.pk, email, timestamp, flag,
+                                               user.email, user.password, last_login, user.is_active)
+        return salted_hmac(self.key_salt, value).hexdigest()[::2]
+
+    def make_token(self, user, email, activate=False):
+        """
+        Return a signed validation key (EMAIL_VALIDATION_SIGNED) with the user
+        id, the time it was issued, whether the user has to be activated and
+        the email, which is verified without the EmailValidation table
+        """
+        timestamp = int_to_base36(int(time.time()))
+        flag = activate and '1' or '0'
+        encoded = base64.urlsafe_b64encode(smart_str(email)).rstrip('=')
+        return "%s-%s-%s-%s-%s" % (int_to_base36(user.pk), timestamp, flag, encoded,
+                                   self.sign(user, email, timestamp, flag))
+
+    def check_token(self, token):
+        """
+        Return the user, email and activation flag of a signed key, or None
+        if the key isn't valid, has expired or the user has changed since it
+        was issued
+        """
+        try:
+            uid, timestamp, flag, rest = token.split('-', 3)
+            encoded, signature = rest.rsplit('-', 1)
+            user_id = base36_to_int(uid)
+            issued = base36_to_int(timestamp)
+            email = base64.urlsafe_b64decode(str(encoded) + '=' * (-len(encoded) % 4)).decode('utf-8')
+        except Exception:
+            return None
+        if issued + settings.EMAIL_CONFIRMATION_DELAY * 24 * 60 * 60 <= time.time():
+            return None
+        try:
+            user = User.objects.get(pk=user_id)
+        except User.DoesNotExist:
+            return None
+        if not constant_time_compare(signature, self.sign(user, email, timestamp, flag)):
+            return None
+        return user, email, flag == '1'
+
+    def verify_token(self, token):
+        """
+        Verify a signed key, updating the user only if it hasn't changed
+        since the key was checked. Activating the user sets its last login,
+        so activation keys can only be used once.
+        """
+        checked = self.check_token(token)
+        if checked is None:
+            return False
+        user, email, activate = checked
+        if User.objects.filter(email__iexact=email).exclude(pk=user.pk).exists():
+            # several users can ask for the same address, the first one wins
+            return False
+        users = User.objects.filter(pk=user.pk, email=user.email, password=user.password, is_active=user.is_active)
+        fields = { 'email': email }
+        if activate:
+            users = users.filter(last_login=user.last_login)
+            fields['is_active'] = True
+            fields['last_login'] = datetime.datetime.now()
+        return users.update(**fields) == 1
+
+    def resend(self, **lookup):
+        """
+        Resend the pending validation of a user or of an email (user= or
+        email= argument). Return False if there isn't any. With signed keys
+        only the validations of new users can be resent, as the new address
+        of an email change isn't stored anywhere.
+        """
+        try:
+            return self.exclude(verified=True).get(**lookup).resend()
+        except EmailValidation.DoesNotExist:
+            if not settings.EMAIL_VALIDATION_SIGNED:
+                return False
+        users = User.objects.filter(is_active=False)
+        if 'user' in lookup:
+            users = users.filter(pk=lookup['user'].pk)
+        else:
+            users = users.filter(email=lookup['email'])
+        for user in users[:1]:
+            self.add(user, user.email)
+            return True
+        return False
+
     def getuser(self, key):
         try:
             return self.get(key=key).user
@@ -175,21 +893,28 @@ class EmailValidationManager(models.Manager):
 
     def add(self, user, email):
         """
-        Add a new validation process entry
+        Add a new validation process entry, or only send a signed key if
+        EMAIL_VALIDATION_SIGNED is set
         """
-        while True:
-            key = User.objects.make_random_password(70)
-            try:
-                EmailValidation.objects.get(key=key)
-            except EmailValidation.DoesNotExist:
-                break
+        if settings.EMAIL_VALIDATION_SIGNED:
+            activate = settings.REQUIRE_EMAIL_CONFIRMATION and not user.is_active
+            key = self.make_token(user, email, activate)
+        else:
+            while True:
+                key = User.objects.make_random_password(70)
+                try:
+                    EmailValidation.objects.get(key=key)
+                except EmailValidation.DoesNotExist:
+                    break
 
         template_body = "userprofile/email/validation.txt"
         template_subject = "userprofile/email/validation_subject.txt"
         site_name, domain = Site.objects.get_current().name, Site.objects.get_current().domain
         body = loader.get_template(template_body).render(Context(locals()))
         subject = loader.get_template(template_subject).render(Context(locals())).strip()
-        send_mail(subject=subject, message=body, from_email=None, recipient_list=[email])
+        QueuedEmail.objects.enqueue(subject, body, [email])
+        if settings.EMAIL_VALIDATION_SIGNED:
+            return None
         user = User.objects.get(username=str(user))
         self.filter(user=user).delete()
         return self.create(user=user, key=key, email=email)
@@ -227,7 +952,7 @@ class EmailValidation(models.Model):
         key = self.key
         body = loader.get_template(template_body).render(Context(locals()))
         subject = loader.get_template(template_subject).render(Context(locals())).strip()
-        send_mail(subject=subject, message=body, from_email=None, recipient_list=[self.email])
+        QueuedEmail.objects.enqueue(subject, body, [self.email])
         self.created = datetime.datetime.now()
         self.save()
         return True
@@ -15,6 +15,15 @@ DEFAULT_AVATAR_FOR_INACTIVES_USER = getattr(settings, 'DEFAULT_AVATAR_FOR_INACTI
 # see http://www.pythonware.com/library/pil/handbook/format-jpeg.htm and format-png.htm for options
 SAVE_IMG_PARAMS = getattr(settings, 'SAVE_IMG_PARAMS', {})
 
+# Encoded images up to this size (in bytes) are kept in memory before being
+# stored, bigger ones are spooled to a temporary file
+AVATAR_SPOOL_MAX_SIZE = getattr(settings, 'AVATAR_SPOOL_MAX_SIZE', 2 ** 20)
+
+# Modern formats ('WEBP', 'AVIF') in which every thumbnail is also generated,
+# in order of preference. Formats not supported by the installed PIL are
+# ignored. Their SAVE_IMG_PARAMS are used too, e.g. {'WEBP': {'quality': 80}}
+AVATAR_MODERN_FORMATS = getattr(settings, 'AVATAR_MODERN_FORMATS', ())
+
 AVATARS_DIR = getattr(settings, 'AVATARS_DIR', os.path.join(settings.MEDIA_ROOT, 'avatars'))
 
 # If set to True, it will enable the Google Picasa web search of avatars.
@@ -23,20 +32,121 @@ AVATAR_WEBSEARCH = getattr(settings, 'AVATAR_WEBSEARCH', False)
 # Max upload size (in MB) of the avatar image.
 AVATAR_QUOTA = getattr(settings, 'AVATAR_QUOTA', None)
 
+# Max number of pixels (width x height) of an uploaded avatar image. Bigger
+# images are rejected from their header, before being decoded
+AVATAR_MAX_PIXELS = getattr(settings, 'AVATAR_MAX_PIXELS', 50 * 10 ** 6)
+
+# Avatars given as an url are downloaded with these limits: seconds to wait
+# for the connection or for data, seconds for the whole download, and bytes
+AVATAR_FETCH_TIMEOUT = getattr(settings, 'AVATAR_FETCH_TIMEOUT', 5)
+AVATAR_FETCH_MAX_TIME = getattr(settings, 'AVATAR_FETCH_MAX_TIME', 20)
+AVATAR_FETCH_MAX_SIZE = getattr(settings, 'AVATAR_FETCH_MAX_SIZE', (AVATAR_QUOTA or 5) * 2 ** 20)
+
+# Downloads of avatar urls running at the same time on every process, further
+# ones are rejected
+AVATAR_FETCH_CONCURRENCY = getattr(settings, 'AVATAR_FETCH_CONCURRENCY', 4)
+
+# Seconds to keep downloaded avatar urls in the cache
+AVATAR_FETCH_CACHE_TIMEOUT = getattr(settings, 'AVATAR_FETCH_CACHE_TIMEOUT', 10 * 60)
+
 # Media storage for static files
 MEDIA_STORAGE = getattr(settings, 'AVATAR_MEDIA_STORAGE', default_storage)
 
-REMOVE_LOST_AVATAR = getattr(settings, 'REMOVE_LOST_AVATAR', True) 
+# Number of threads deleting the files of an avatar in parallel, when the
+# storage has no delete_many() method
+AVATAR_DELETE_WORKERS = getattr(settings, 'AVATAR_DELETE_WORKERS', 8)
+
+# If set to True, the files of deleted avatars are removed from the storage
+# by a background thread, after the response
+AVATAR_DEFERRED_DELETE = getattr(settings, 'AVATAR_DEFERRED_DELETE', False)
+
+# If set to True, "manage.py sweep_avatars" deletes the avatars whose image
+# file is missing from the storage
+REMOVE_LOST_AVATAR = getattr(settings, 'REMOVE_LOST_AVATAR', True)
+
+# If set to True, avatar images are named after the hash of their content
+# (avatars/<xx>/<sha1>.<ext>), so their urls never change and can be cached
+# forever, and identical images are stored only once
+AVATAR_CONTENT_ADDRESSED = getattr(settings, 'AVATAR_CONTENT_ADDRESSED', False)
+
+# Seconds to remember in the cache that a resized thumbnail exists on the
+# media storage (None means the default cache timeout)
+AVATAR_THUMBNAIL_CACHE_TIMEOUT = getattr(settings, 'AVATAR_THUMBNAIL_CACHE_TIMEOUT', 60 * 60 * 24 * 30)
+
+# If set to True, missing thumbnails are generated by a pool of background
+# threads (AVATAR_THUMBNAIL_WORKERS per process) and the default avatar is
+# shown meanwhile
+AVATAR_ASYNC_THUMBNAILS = getattr(settings, 'AVATAR_ASYNC_THUMBNAILS', False)
+AVATAR_THUMBNAIL_WORKERS = getattr(settings, 'AVATAR_THUMBNAIL_WORKERS', 2)
+
+# How the avatar_image view hands local avatar files to the front-end server:
+#  - None (the default), redirect to the storage url
+#  - 'sendfile', X-Sendfile header (Apache mod_xsendfile, lighttpd)
+#  - 'accel-redirect', X-Accel-Redirect header (nginx), pointing to
+#    AVATAR_SERVE_PREFIX + the file name, an internal location mapped to the
+#    avatars storage
+AVATAR_SERVE_BACKEND = getattr(settings, 'AVATAR_SERVE_BACKEND', None)
+AVATAR_SERVE_PREFIX = getattr(settings, 'AVATAR_SERVE_PREFIX', '/protected/')
+# Cache-Control max-age of the avatar_image view responses
+AVATAR_SERVE_MAX_AGE = getattr(settings, 'AVATAR_SERVE_MAX_AGE', 60 * 60)
 
 # You need a valid Google Maps API Key so your users can use the Google
 # Maps positioning functionality. Obtain one for your site name here:
 # http://www.google.com/apis/maps/signup.html
 GOOGLE_MAPS_API_KEY = getattr(settings, 'GOOGLE_MAPS_API_KEY', None)
 
+# Boundaries of the regions used to find the country and region of the
+# coordinates chosen on the map, without network access: a file compiled by
+# "manage.py compile_boundaries", memory mapped by every process, or a
+# GeoJSON file (Polygon or MultiPolygon features) loaded by every process.
+# The properties of every feature holding the ISO country code and the region
+# name are given below. If None, the geonames.org web service is queried
+# (waiting up to GEODATA_TIMEOUT seconds)
+GEODATA_BOUNDARIES = getattr(settings, 'GEODATA_BOUNDARIES', None)
+GEODATA_COUNTRY_PROPERTY = getattr(settings, 'GEODATA_COUNTRY_PROPERTY', 'iso_a2')
+GEODATA_REGION_PROPERTY = getattr(settings, 'GEODATA_REGION_PROPERTY', 'name')
+GEODATA_TIMEOUT = getattr(settings, 'GEODATA_TIMEOUT', 5)
+
+# Geodata lookups are cached for the coordinates rounded to this number of
+# decimals (2 decimals are about 1 km), in a cache of GEODATA_CACHE_SIZE
+# entries per process and, for GEODATA_CACHE_TIMEOUT seconds (0 to disable),
+# in the django cache. Unknown places are cached for
+# GEODATA_NEGATIVE_CACHE_TIMEOUT seconds
+GEODATA_CACHE_PRECISION = getattr(settings, 'GEODATA_CACHE_PRECISION', 2)
+GEODATA_CACHE_SIZE = getattr(settings, 'GEODATA_CACHE_SIZE', 10000)
+GEODATA_CACHE_TIMEOUT = getattr(settings, 'GEODATA_CACHE_TIMEOUT', 0)
+GEODATA_NEGATIVE_CACHE_TIMEOUT = getattr(settings, 'GEODATA_NEGATIVE_CACHE_TIMEOUT', 10 * 60)
+
+# Cache option of the GeoIP database used to locate the user from its ip
+# address: 0 reads it from disk through the page cache of the OS, shared by
+# every worker, 1 loads it in the memory of every process. The recent
+# lookups (GEOIP_CACHE_SIZE addresses) are kept by every process
+GEOIP_CACHE_OPTION = getattr(settings, 'GEOIP_CACHE_OPTION', 0)
+GEOIP_CACHE_SIZE = getattr(settings, 'GEOIP_CACHE_SIZE', 1000)
+
+# Profiles per page of the country directory, and seconds to cache the number
+# of profiles per country (the cache is cleared when they change)
+COUNTRY_DIRECTORY_PAGE_SIZE = getattr(settings, 'COUNTRY_DIRECTORY_PAGE_SIZE', 20)
+COUNTRY_COUNTS_CACHE_TIMEOUT = getattr(settings, 'COUNTRY_COUNTS_CACHE_TIMEOUT', 60 * 60)
+
 # If set to True, the user e-mail will be required to get an account on the system.
 EMAIL_CONFIRMATION_DELAY = getattr(settings, 'EMAIL_CONFIRMATION_DELAY', 1)
 REQUIRE_EMAIL_CONFIRMATION = getattr(settings, 'REQUIRE_EMAIL_CONFIRMATION', False)
 
+# If set to True, the email validation links carry a signed key, checked
+# without the database, instead of a random key stored on the
+# EmailValidation table
+EMAIL_VALIDATION_SIGNED = getattr(settings, 'EMAIL_VALIDATION_SIGNED', False)
+
+# If set to True, the validation emails are queued on the QueuedEmail table,
+# to be sent by "manage.py send_queued_email", instead of being sent during
+# the request. Failed emails are retried up to EMAIL_OUTBOX_MAX_ATTEMPTS
+# times, after EMAIL_OUTBOX_RETRY_DELAY seconds and doubling the delay every
+# time
+EMAIL_OUTBOX = getattr(settings, 'EMAIL_OUTBOX', False)
+EMAIL_OUTBOX_MAX_ATTEMPTS = getattr(settings, 'EMAIL_OUTBOX_MAX_ATTEMPTS', 8)
+EMAIL_OUTBOX_RETRY_DELAY = getattr(settings, 'EMAIL_OUTBOX_RETRY_DELAY', 60)
+
 # Specify which set of classes use for html structure of django-profile
 #  - blueprint (the default, for blueprint css framework, full width)
 #  - 960gs-12 (for 960.gs css framework, 12 columns, full width)
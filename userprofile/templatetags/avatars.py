@@ -1,11 +1,35 @@
 # coding=UTF-8
 from django.template import Library, Node, TemplateSyntaxError, Variable
+from django.utils.html import escape
 from django.utils.translation import ugettext as _
 from userprofile.models import Avatar
 from userprofile.settings import AVATAR_SIZES, DEFAULT_AVATAR_SIZE
+from userprofile.thumbnails import FORMAT_MIMETYPES, modern_formats, \
+    negotiate_format
 
 register = Library()
 
+PREFETCH_CONTEXT_VAR = '_userprofile_avatar_urls'
+
+def request_format(context):
+    """
+    Modern image format accepted by the browser of the current request, if
+    the request is available on the context
+    """
+    request = context.get('request')
+    if request is None:
+        return None
+    return negotiate_format(request.META.get('HTTP_ACCEPT'))
+
+def get_avatar(context, user):
+    """
+    Avatar of the user, from the {% prefetch_avatars %} cache if available
+    """
+    avatars = context.get(PREFETCH_CONTEXT_VAR, {}).get('avatars', {})
+    if getattr(user, 'pk', None) in avatars:
+        return avatars[user.pk]
+    return Avatar.objects.get_for_user(user)
+
 class ResizedThumbnailNode(Node):
     def __init__(self, size, username=None):
         try:
@@ -28,8 +52,60 @@ class ResizedThumbnailNode(Node):
             return ''
 
         user = self.user.resolve(context)
-        avatar = Avatar.objects.get_for_user(user)
-        return avatar.get_resized_image_url(size)
+        img_format = request_format(context)
+        prefetched = context.get(PREFETCH_CONTEXT_VAR, {}).get((size, img_format), {})
+        if getattr(user, 'pk', None) in prefetched:
+            return prefetched[user.pk]
+        return get_avatar(context, user).get_resized_image_url(size, img_format)
+
+class PictureNode(ResizedThumbnailNode):
+    def render(self, context):
+        size = self.size
+        if not isinstance(size, int):
+            size = int(self.size.resolve(context))
+
+        if not size in AVATAR_SIZES:
+            return ''
+
+        user = self.user.resolve(context)
+        avatar = get_avatar(context, user)
+        sources = ['<source type="%s" srcset="%s" />' % \
+                   (FORMAT_MIMETYPES[img_format], escape(avatar.get_resized_image_url(size, img_format))) \
+                   for img_format in modern_formats()]
+        return '<picture>%s<img src="%s" alt="%s" /></picture>' % \
+            (''.join(sources), escape(avatar.get_resized_image_url(size)), escape(user))
+
+class PrefetchAvatarsNode(Node):
+    def __init__(self, users, sizes):
+        self.users = Variable(users)
+        self.sizes = []
+        for size in sizes:
+            try:
+                self.sizes.append(int(size))
+            except:
+                self.sizes.append(Variable(size))
+
+    def render(self, context):
+        sizes = []
+        for size in self.sizes:
+            if not isinstance(size, int):
+                size = int(size.resolve(context))
+            if size in AVATAR_SIZES:
+                sizes.append(size)
+
+        # Accept lists of users or lists of profiles
+        users = list(self.users.resolve(context))
+        if not (users and sizes):
+            return ''
+
+        avatars = Avatar.objects.get_for_users(users)
+        img_format = request_format(context)
+        prefetched = context.get(PREFETCH_CONTEXT_VAR, {})
+        prefetched.setdefault('avatars', {}).update(avatars)
+        for size in sizes:
+            prefetched.setdefault((size, img_format), {}).update(Avatar.objects.get_urls(avatars, size, img_format))
+        context[PREFETCH_CONTEXT_VAR] = prefetched
+        return ''
 
 @register.tag('avatar')
 def Thumbnail(parser, token):
@@ -44,3 +120,39 @@ def Thumbnail(parser, token):
     elif len(bits) < 2:
         bits.append(str(DEFAULT_AVATAR_SIZE))
     return ResizedThumbnailNode(bits[1], username)
+
+@register.tag('avatar_picture')
+def Picture(parser, token):
+    """
+    Render a <picture> element with a <source> for every modern format of
+    the avatar (AVATAR_MODERN_FORMATS) and the source format as fallback,
+    so the browser picks the format. Same arguments as {% avatar %}.
+    """
+    bits = token.contents.split()
+    username = None
+    if len(bits) > 3:
+        raise TemplateSyntaxError, _(u"You have to provide only the size as \
+            an integer (both sides will be equal) and optionally, the \
+            username.")
+    elif len(bits) == 3:
+        username = bits[2]
+    elif len(bits) < 2:
+        bits.append(str(DEFAULT_AVATAR_SIZE))
+    return PictureNode(bits[1], username)
+
+@register.tag('prefetch_avatars')
+def PrefetchAvatars(parser, token):
+    """
+    Resolve the avatars of a list of users (or profiles) with a single query,
+    so the {% avatar %} tags that follow don't hit the database per user.
+
+        {% prefetch_avatars profiles 64 %}
+        {% for profile in profiles %}{% avatar 64 profile.user %}{% endfor %}
+    """
+    bits = token.contents.split()
+    if len(bits) < 2:
+        raise TemplateSyntaxError, _(u"You have to provide the list of users \
+            and optionally, the sizes to prefetch.")
+    elif len(bits) == 2:
+        bits.append(str(DEFAULT_AVATAR_SIZE))
+    return PrefetchAvatarsNode(bits[1], bits[2:])
@@ -0,0 +1,697 @@
+"""
+Tests of userprofile. Run them from a project with the application
+installed, for instance the demo:
+
+    $ cd demo && PYTHONPATH=.. python manage.py test userprofile
+"""
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadhandler import StopUpload
+from django.core.cache import cache
+from django.core.mail.backends.locmem import EmailBackend
+from django.core.mail.backends.smtp import EmailBackend as SMTPEmailBackend
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import simplejson
+from django.utils.http import base36_to_int, int_to_base36
+from userprofile import fetch, geodata, geohash
+from userprofile.exceptions import RemoteImageError
+from userprofile.management.commands import sweep_avatars
+from userprofile.models import Avatar, EmailValidation, QueuedEmail, get_profile_model
+from userprofile.uploadhandler import AvatarUploadHandler
+import asyncore
+import base64
+import datetime
+import os
+import random
+import shutil
+import smtpd
+import socket
+import tempfile
+import threading
+import time
+import userprofile.settings
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+
+def image_data(img_format='PNG', size=(40, 30)):
+    f = StringIO()
+    Image.new('RGB', size, (10, 200, 10)).save(f, img_format)
+    return f.getvalue()
+
+
+class SettingsMixin(object):
+    """
+    Override userprofile settings during a test, see override()
+    """
+    def override(self, **values):
+        for name, value in values.items():
+            self.addCleanup(setattr, userprofile.settings, name, getattr(userprofile.settings, name))
+            setattr(userprofile.settings, name, value)
+
+
+class ImageRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serve the responses of ImageServer.pages (path => (content type, body,
+    seconds to wait before the body))
+    """
+    def do_GET(self):
+        self.server.hits.append(self.path)
+        if self.path not in self.server.pages:
+            self.send_error(404)
+            return
+        content_type, body, delay = self.server.pages[self.path]
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        time.sleep(delay)
+        try:
+            self.wfile.write(body)
+        except IOError:
+            # the client gave up
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class ImageServer(ThreadingMixIn, HTTPServer):
+    """
+    Local stand-in for the hosts of remote avatars
+    """
+    daemon_threads = True
+
+    def __init__(self, pages):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), ImageRequestHandler)
+        self.pages = pages
+        self.hits = []
+        self.thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def url(self, path):
+        return "http://127.0.0.1:%d%s" % (self.server_address[1], path)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FetchImageTest(SettingsMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.png = image_data('PNG')
+        self.server = ImageServer({
+            '/avatar.png': ('image/png', self.png, 0),
+            '/mislabeled': ('text/plain', self.png, 0),
+            '/page.html': ('text/html', '<html><body>Not an image</body></html>', 0),
+            '/big.png': ('image/png', image_data('PNG', (2000, 2000)), 0),
+            '/slow.png': ('image/png', self.png, 2),
+        })
+        self.addCleanup(self.server.stop)
+
+    def test_fetch(self):
+        f = fetch.fetch_image(self.server.url('/avatar.png'))
+        self.assertEqual(f.read(), self.png)
+        self.assertEqual(f.name, 'avatar.png')
+        self.assertEqual(f.content_type, 'image/png')
+
+    def test_content_type_from_image(self):
+        f = fetch.fetch_image(self.server.url('/mislabeled'))
+        self.assertEqual(f.content_type, 'image/png')
+
+    def test_cached(self):
+        url = self.server.url('/avatar.png')
+        fetch.fetch_image(url)
+        f = fetch.fetch_image(url)
+        self.assertEqual(f.read(), self.png)
+        self.assertEqual(self.server.hits, ['/avatar.png'])
+
+    def test_not_an_image(self):
+        self.assertRaises(RemoteImageError, fetch.fetch_image, self.server.url('/page.html'))
+
+    def test_not_found(self):
+        self.assertRaises(RemoteImageError, fetch.fetch_image, self.server.url('/missing.png'))
+
+    def test_scheme(self):
+        self.assertRaises(RemoteImageError, fetch.fetch_image, 'file:///etc/passwd')
+        self.assertEqual(self.server.hits, [])
+
+    def test_max_size(self):
+        self.override(AVATAR_FETCH_MAX_SIZE=len(self.png) - 1)
+        self.assertRaises(RemoteImageError, fetch.fetch_image, self.server.url('/avatar.png'))
+
+    def test_max_pixels(self):
+        self.override(AVATAR_MAX_PIXELS=1000 * 1000)
+        self.assertRaises(RemoteImageError, fetch.fetch_image, self.server.url('/big.png'))
+
+    def test_timeout(self):
+        self.override(AVATAR_FETCH_TIMEOUT=0.5)
+        start = time.time()
+        self.assertRaises(RemoteImageError, fetch.fetch_image, self.server.url('/slow.png'))
+        self.assertTrue(time.time() - start < 2)
+
+    def test_concurrency(self):
+        acquired = 0
+        while fetch.slots.acquire(False):
+            acquired += 1
+        try:
+            self.assertRaises(RemoteImageError, fetch.fetch_image, self.server.url('/avatar.png'))
+        finally:
+            for i in range(acquired):
+                fetch.slots.release()
+        self.assertEqual(self.server.hits, [])
+        self.assertEqual(acquired, userprofile.settings.AVATAR_FETCH_CONCURRENCY)
+
+
+class StubGeoIP(object):
+    """
+    GeoIP city database of a few documentation addresses
+    """
+    records = {
+        '192.0.2.1': {'city': 'Madrid', 'country_code': 'ES', 'latitude': 40.4, 'longitude': -3.7},
+        '198.51.100.1': {'city': 'Lyon', 'country_code': 'FR', 'latitude': 45.76, 'longitude': 4.84},
+    }
+
+    def __init__(self):
+        self.lookups = []
+
+    def city(self, ip):
+        self.lookups.append(ip)
+        return self.records.get(ip)
+
+
+class StubGeoIPReader(geodata.GeoIPReader):
+    def __init__(self, size):
+        super(StubGeoIPReader, self).__init__(size)
+        self.opened = 0
+
+    def open(self):
+        self.opened += 1
+        return StubGeoIP()
+
+
+class GeoIPReaderTest(TestCase):
+    def setUp(self):
+        self.reader = StubGeoIPReader(2)
+
+    def test_city(self):
+        self.assertEqual(self.reader.city('192.0.2.1')['city'], 'Madrid')
+        self.assertEqual(self.reader.city('203.0.113.1'), None)
+        self.assertEqual(self.reader.city(None), None)
+        self.assertEqual(self.reader.city(''), None)
+
+    def test_opened_once(self):
+        self.assertEqual(self.reader.opened, 0)
+        self.reader.city('192.0.2.1')
+        self.reader.city('198.51.100.1')
+        self.assertEqual(self.reader.opened, 1)
+
+    def test_cache(self):
+        for i in range(3):
+            self.reader.city('192.0.2.1')
+            self.reader.city('203.0.113.1')
+        self.assertEqual(self.reader.geoip.lookups, ['192.0.2.1', '203.0.113.1'])
+
+    def test_least_recently_used(self):
+        self.reader.city('192.0.2.1')
+        self.reader.city('198.51.100.1')
+        self.reader.city('192.0.2.1')
+        self.reader.city('203.0.113.1')
+        # 198.51.100.1 was dropped, 192.0.2.1 was used more recently
+        self.reader.city('192.0.2.1')
+        self.reader.city('198.51.100.1')
+        self.assertEqual(self.reader.geoip.lookups, ['192.0.2.1', '198.51.100.1', '203.0.113.1', '198.51.100.1'])
+
+    def test_reopened_after_fork(self):
+        self.reader.city('192.0.2.1')
+        # as seen from a forked worker
+        self.reader.pid = None
+        self.reader.city('198.51.100.1')
+        self.assertEqual(self.reader.opened, 2)
+
+
+
+class NearTest(TestCase):
+    # points on the edges of geohash cells (the equator, the meridians
+    # splitting the cells, the antimeridian) and around the poles
+    CENTERS = [(0, 0), (45, 90), (0, 179.99), (-0.001, -179.999), (89.95, 10), (-89.99, -120),
+               (geohash.cell_size(5)[0] * 7, geohash.cell_size(5)[1] * -3)]
+    RADIUSES = [1, 10, 50, 300, 2000, 8000]
+
+    def setUp(self):
+        Profile = get_profile_model()
+        rand = random.Random(0)
+        for lat, lng in self.CENTERS:
+            for i in range(40):
+                # from a few meters to a few hundred km away
+                spread = 10 ** rand.uniform(-4, 0.5)
+                point_lat = max(-90, min(90, lat + rand.uniform(-spread, spread)))
+                point_lng = (lng + rand.uniform(-spread, spread) + 180) % 360 - 180
+                user = User.objects.create(username='user%d' % User.objects.count())
+                Profile.objects.create(user=user, latitude="%.6f" % point_lat, longitude="%.6f" % point_lng)
+        # without coordinates
+        Profile.objects.create(user=User.objects.create(username='nowhere'))
+        self.profiles = list(Profile.objects.all())
+
+    def brute_force(self, lat, lng, radius):
+        found = []
+        for profile in self.profiles:
+            if profile.latitude is None:
+                continue
+            distance = geohash.distance(lat, lng, float(profile.latitude), float(profile.longitude))
+            if distance <= radius:
+                found.append((distance, profile.pk))
+        found.sort()
+        return found
+
+    def test_near(self):
+        Profile = get_profile_model()
+        for lat, lng in self.CENTERS:
+            for radius in self.RADIUSES:
+                expected = self.brute_force(lat, lng, radius)
+                found = Profile.objects.near(lat, lng, radius)
+                self.assertEqual(sorted(profile.pk for profile in found), sorted(pk for d, pk in expected),
+                                 "near(%s, %s, %s)" % (lat, lng, radius))
+                self.assertEqual([profile.distance for profile in found], [d for d, pk in expected])
+
+    def test_limit(self):
+        Profile = get_profile_model()
+        expected = self.brute_force(0, 179.99, 300)[:5]
+        found = Profile.objects.near(0, 179.99, 300, limit=5)
+        self.assertEqual([profile.distance for profile in found], [d for d, pk in expected])
+
+
+class FailingEmailBackend(EmailBackend):
+    """
+    locmem backend failing to send to the addresses of the failing list
+    """
+    failing = ['broken@example.com']
+
+    def send_messages(self, messages):
+        for message in messages:
+            if [address for address in message.recipients() if address in self.failing]:
+                raise IOError("Connection reset by peer")
+        return super(FailingEmailBackend, self).send_messages(messages)
+
+
+class QueuedEmailTest(SettingsMixin, TestCase):
+    def setUp(self):
+        self.override(EMAIL_OUTBOX=True, EMAIL_OUTBOX_RETRY_DELAY=60, EMAIL_OUTBOX_MAX_ATTEMPTS=3)
+
+    def make_due(self):
+        QueuedEmail.objects.update(next_attempt=datetime.datetime.now() - datetime.timedelta(seconds=1))
+
+    def test_without_outbox(self):
+        self.override(EMAIL_OUTBOX=False)
+        self.assertEqual(QueuedEmail.objects.enqueue("Hello", "Body", ['ana@example.com']), None)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['ana@example.com'])
+        self.assertEqual(QueuedEmail.objects.count(), 0)
+
+    def test_enqueue(self):
+        email = QueuedEmail.objects.enqueue("Hello", "Body", ['ana@example.com', 'bob@example.com'])
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(email.recipients, 'ana@example.com\nbob@example.com')
+        self.assertEqual(email.attempts, 0)
+
+    def test_send_queued(self):
+        for i in range(5):
+            QueuedEmail.objects.enqueue("Hello %d" % i, "Body", ['user%d@example.com' % i], 'site@example.com')
+        stats = QueuedEmail.objects.send_queued(batch_size=3)
+        self.assertEqual((stats['sent'], stats['failed']), (3, 0))
+        self.assertEqual([message.subject for message in mail.outbox], ["Hello 0", "Hello 1", "Hello 2"])
+        self.assertEqual(mail.outbox[0].to, ['user0@example.com'])
+        self.assertEqual(mail.outbox[0].from_email, 'site@example.com')
+        self.assertEqual(QueuedEmail.objects.count(), 2)
+        QueuedEmail.objects.send_queued(batch_size=3)
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(QueuedEmail.objects.count(), 0)
+        self.assertEqual(QueuedEmail.objects.send_queued()['sent'], 0)
+
+    def test_failure(self):
+        QueuedEmail.objects.enqueue("Hello", "Body", ['ana@example.com'])
+        broken = QueuedEmail.objects.enqueue("Hello", "Body", ['broken@example.com'])
+        started = datetime.datetime.now()
+        stats = QueuedEmail.objects.send_queued(connection=FailingEmailBackend())
+        self.assertEqual((stats['sent'], stats['failed']), (1, 1))
+        self.assertEqual(len(mail.outbox), 1)
+        broken = QueuedEmail.objects.get(pk=broken.pk)
+        self.assertEqual(broken.attempts, 1)
+        self.assertEqual(broken.last_error, "IOError: Connection reset by peer")
+        self.assertTrue(broken.next_attempt >= started + datetime.timedelta(seconds=60))
+        # not retried before it's due
+        self.assertEqual(QueuedEmail.objects.send_queued(connection=FailingEmailBackend())['failed'], 0)
+
+        self.make_due()
+        QueuedEmail.objects.send_queued(connection=FailingEmailBackend())
+        broken = QueuedEmail.objects.get(pk=broken.pk)
+        self.assertEqual(broken.attempts, 2)
+        # twice as long after every attempt
+        self.assertTrue(broken.next_attempt >= datetime.datetime.now() + datetime.timedelta(seconds=119))
+
+    def test_retry(self):
+        email = QueuedEmail.objects.enqueue("Hello", "Body", ['broken@example.com'])
+        QueuedEmail.objects.send_queued(connection=FailingEmailBackend())
+        self.make_due()
+        stats = QueuedEmail.objects.send_queued()
+        self.assertEqual((stats['sent'], stats['failed']), (1, 0))
+        self.assertEqual(mail.outbox[0].to, ['broken@example.com'])
+        self.assertEqual(QueuedEmail.objects.filter(pk=email.pk).count(), 0)
+
+    def test_max_attempts(self):
+        email = QueuedEmail.objects.enqueue("Hello", "Body", ['broken@example.com'])
+        for i in range(5):
+            self.make_due()
+            QueuedEmail.objects.send_queued(connection=FailingEmailBackend())
+        self.assertEqual(QueuedEmail.objects.get(pk=email.pk).attempts, 3)
+        self.make_due()
+        self.assertEqual(QueuedEmail.objects.send_queued()['sent'], 0)
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_command(self):
+        for i in range(3):
+            QueuedEmail.objects.enqueue("Hello", "Body", ['user%d@example.com' % i])
+        call_command('send_queued_email', batch_size=2, verbosity=0)
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(QueuedEmail.objects.count(), 1)
+
+
+class SMTPStub(smtpd.SMTPServer):
+    """
+    Local SMTP server counting the connections, rejecting the messages to
+    the addresses of the rejected list
+    """
+    rejected = ['broken@example.com']
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.connections = 0
+        self.messages = []
+        self.running = True
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def serve(self):
+        while self.running:
+            asyncore.loop(0.05, count=1)
+
+    def handle_accept(self):
+        self.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        if [address for address in rcpttos if address in self.rejected]:
+            return '554 Rejected'
+        self.messages.append(rcpttos)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        asyncore.close_all()
+
+
+class QueuedEmailSMTPTest(SettingsMixin, TestCase):
+    def setUp(self):
+        self.override(EMAIL_OUTBOX=True, EMAIL_OUTBOX_RETRY_DELAY=60, EMAIL_OUTBOX_MAX_ATTEMPTS=3)
+        self.server = SMTPStub()
+        self.addCleanup(self.server.stop)
+
+    def backend(self, port=None):
+        return SMTPEmailBackend(host='127.0.0.1', port=port or self.server.port)
+
+    def test_single_connection(self):
+        for i in range(5):
+            QueuedEmail.objects.enqueue("Hello %d" % i, "Body", ['user%d@example.com' % i])
+        backend = self.backend()
+        stats = QueuedEmail.objects.send_queued(connection=backend)
+        self.assertEqual((stats['sent'], stats['failed']), (5, 0))
+        self.assertEqual(len(self.server.messages), 5)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(backend.connection, None)
+        # nothing to send
+        self.assertEqual(QueuedEmail.objects.send_queued(connection=backend)['sent'], 0)
+
+    def test_reconnect_after_failure(self):
+        for address in ('ana@example.com', 'broken@example.com', 'bob@example.com'):
+            QueuedEmail.objects.enqueue("Hello", "Body", [address])
+        stats = QueuedEmail.objects.send_queued(connection=self.backend())
+        self.assertEqual((stats['sent'], stats['failed']), (2, 1))
+        self.assertEqual(self.server.messages, [['ana@example.com'], ['bob@example.com']])
+        self.assertEqual(self.server.connections, 2)
+        broken = QueuedEmail.objects.get()
+        self.assertEqual(broken.attempts, 1)
+        self.assertTrue(broken.last_error.startswith('SMTPDataError'))
+
+    def test_server_down(self):
+        # a port nobody listens to
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+        email = QueuedEmail.objects.enqueue("Hello", "Body", ['ana@example.com'])
+        stats = QueuedEmail.objects.send_queued(connection=self.backend(port))
+        self.assertEqual((stats['sent'], stats['failed']), (0, 1))
+        email = QueuedEmail.objects.get(pk=email.pk)
+        self.assertEqual(email.attempts, 1)
+        self.assertNotEqual(email.last_error, '')
+        self.assertTrue(email.next_attempt > datetime.datetime.now())
+
+
+class SignedEmailValidationTest(SettingsMixin, TestCase):
+    def setUp(self):
+        self.override(EMAIL_VALIDATION_SIGNED=True, REQUIRE_EMAIL_CONFIRMATION=True, EMAIL_CONFIRMATION_DELAY=1)
+        User.objects.create_user('ana', 'ana@example.com', 'secret')
+        # logged in an hour ago, not in the same second as the tests
+        User.objects.update(last_login=datetime.datetime.now() - datetime.timedelta(hours=1))
+        self.user = User.objects.get(username='ana')
+
+    def user_email(self):
+        return User.objects.get(pk=self.user.pk).email
+
+    def test_email_change(self):
+        key = EmailValidation.objects.make_token(self.user, 'new@example.com')
+        self.assertTrue(EmailValidation.objects.verify(key))
+        self.assertEqual(self.user_email(), 'new@example.com')
+        # used
+        self.assertFalse(EmailValidation.objects.verify(key))
+
+    def test_login_before_email_change(self):
+        key = EmailValidation.objects.make_token(self.user, 'new@example.com')
+        # on another device
+        self.assertTrue(self.client.login(username='ana', password='secret'))
+        self.assertTrue(EmailValidation.objects.verify(key))
+        self.assertEqual(self.user_email(), 'new@example.com')
+
+    def test_activation(self):
+        User.objects.filter(pk=self.user.pk).update(is_active=False, email='')
+        user = User.objects.get(pk=self.user.pk)
+        key = EmailValidation.objects.make_token(user, 'ana@example.com', activate=True)
+        self.assertTrue(EmailValidation.objects.verify(key))
+        user = User.objects.get(pk=self.user.pk)
+        self.assertTrue(user.is_active)
+        self.assertEqual(user.email, 'ana@example.com')
+        # replayed after the account was disabled again
+        User.objects.filter(pk=user.pk).update(is_active=False, email='')
+        self.assertFalse(EmailValidation.objects.verify(key))
+        self.assertFalse(User.objects.get(pk=user.pk).is_active)
+
+    def test_tampered(self):
+        key = EmailValidation.objects.make_token(self.user, 'new@example.com')
+        uid, timestamp, flag, encoded, signature = key.split('-')
+        other = User.objects.create_user('bob', 'bob@example.com', 'secret')
+        forged = [
+            '-'.join([uid, timestamp, flag, encoded, signature[:-1] + (signature[-1] == '0' and '1' or '0')]),
+            '-'.join([uid, timestamp, flag, base64.urlsafe_b64encode('evil@example.com').rstrip('='), signature]),
+            '-'.join([uid, timestamp, '1', encoded, signature]),
+            '-'.join([int_to_base36(other.pk), timestamp, flag, encoded, signature]),
+            '-'.join([uid, int_to_base36(base36_to_int(timestamp) + 3600), flag, encoded, signature]),
+            'garbage-key',
+        ]
+        for key in forged:
+            self.assertFalse(EmailValidation.objects.verify(key), key)
+        self.assertEqual(self.user_email(), 'ana@example.com')
+        self.assertEqual(User.objects.get(pk=other.pk).email, 'bob@example.com')
+
+    def test_expired(self):
+        key = EmailValidation.objects.make_token(self.user, 'new@example.com')
+        self.override(EMAIL_CONFIRMATION_DELAY=0)
+        self.assertFalse(EmailValidation.objects.verify(key))
+        self.assertEqual(self.user_email(), 'ana@example.com')
+
+    def test_password_changed(self):
+        key = EmailValidation.objects.make_token(self.user, 'new@example.com')
+        self.user.set_password('other')
+        self.user.save()
+        self.assertFalse(EmailValidation.objects.verify(key))
+
+    def test_newer_change(self):
+        older = EmailValidation.objects.make_token(self.user, 'old@example.com')
+        newer = EmailValidation.objects.make_token(self.user, 'new@example.com')
+        self.assertTrue(EmailValidation.objects.verify(newer))
+        self.assertFalse(EmailValidation.objects.verify(older))
+        self.assertEqual(self.user_email(), 'new@example.com')
+
+    def test_address_taken(self):
+        key = EmailValidation.objects.make_token(self.user, 'bob@example.com')
+        User.objects.create_user('bob', 'bob@example.com', 'secret')
+        self.assertFalse(EmailValidation.objects.verify(key))
+        self.assertEqual(self.user_email(), 'ana@example.com')
+
+
+class SweepAvatarsTest(TestCase):
+    def setUp(self):
+        self.storage = FileSystemStorage(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.storage.location)
+        os.mkdir(self.storage.path('avatars'))
+        field = Avatar._meta.get_field('image')
+        for owner, name in ((field, 'storage'), (sweep_avatars, 'MEDIA_STORAGE')):
+            self.addCleanup(setattr, owner, name, getattr(owner, name))
+            setattr(owner, name, self.storage)
+        self.user = User.objects.create_user('ana', 'ana@example.com', 'secret')
+
+    def sweep(self, after_listing):
+        """
+        Run the command, calling after_listing() once the storage is listed
+        """
+        def walk(storage, path):
+            files = list(self.walk(storage, path))
+            after_listing()
+            return files
+        self.walk = sweep_avatars.walk
+        self.addCleanup(setattr, sweep_avatars, 'walk', sweep_avatars.walk)
+        sweep_avatars.walk = walk
+        call_command('sweep_avatars', min_age=0, rate=0, verbosity=0)
+
+    def test_new_image_after_listing(self):
+        avatar = Avatar.objects.create(user=self.user, image='avatars/lost.png', valid=False)
+
+        def crop():
+            name = self.storage.save('avatars/cropped.png', ContentFile(image_data()))
+            Avatar.objects.filter(pk=avatar.pk).update(image=name)
+        self.sweep(crop)
+        self.assertEqual(Avatar.objects.get(pk=avatar.pk).image.name, 'avatars/cropped.png')
+        self.assertTrue(self.storage.exists('avatars/cropped.png'))
+
+    def test_lost(self):
+        avatar = Avatar.objects.create(user=self.user, image='avatars/lost.png', valid=False)
+        self.storage.save('avatars/other.png', ContentFile(image_data()))
+        self.sweep(lambda: None)
+        self.assertFalse(Avatar.objects.filter(pk=avatar.pk).exists())
+
+    def test_file_deleted_after_listing(self):
+        self.storage.save('avatars/replaced.png', ContentFile(image_data()))
+        self.storage.save('avatars/orphan.png', ContentFile(image_data()))
+        self.sweep(lambda: self.storage.delete('avatars/replaced.png'))
+        self.assertFalse(self.storage.exists('avatars/orphan.png'))
+
+
+class AvatarUploadHandlerTest(SettingsMixin, TestCase):
+    def setUp(self):
+        self.override(AVATAR_QUOTA=None, AVATAR_MAX_PIXELS=1000 * 1000)
+
+    def upload(self, data, chunk_size=64 * 2 ** 10):
+        """
+        Stream data to the handler, return the reason it was rejected, if any
+        """
+        handler = AvatarUploadHandler()
+        handler.handle_raw_input(None, {}, len(data), 'boundary')
+        try:
+            handler.new_file('avatar', 'avatar', 'application/octet-stream', len(data))
+            for start in range(0, len(data), chunk_size):
+                handler.receive_data_chunk(data[start:start + chunk_size], start)
+            handler.file_complete(len(data))
+        except StopUpload:
+            return handler.error
+        return None
+
+    def noise_webp(self, size, **options):
+        f = StringIO()
+        Image.frombytes('RGB', size, os.urandom(size[0] * size[1] * 3)).save(f, 'WEBP', **options)
+        return f.getvalue()
+
+    def test_images(self):
+        self.assertEqual(self.upload(image_data('PNG')), None)
+        self.assertEqual(self.upload(image_data('JPEG')), None)
+        self.assertEqual(self.upload(image_data('WEBP')), None)
+
+    def test_big_webp(self):
+        for options in ({}, {'lossless': True}):
+            data = self.noise_webp((900, 900), **options)
+            self.assertTrue(len(data) > AvatarUploadHandler.SNIFF_LIMIT)
+            self.assertEqual(self.upload(data), None)
+            # in chunks smaller than the header
+            self.assertEqual(self.upload(data[:1000], chunk_size=7), None)
+
+    def test_too_many_pixels(self):
+        self.assertNotEqual(self.upload(image_data('PNG', (1001, 1000))), None)
+        self.assertNotEqual(self.upload(image_data('WEBP', (1001, 1000))), None)
+        self.assertNotEqual(self.upload(self.noise_webp((1001, 1000), lossless=True)), None)
+
+    def test_not_an_image(self):
+        self.assertNotEqual(self.upload('<html><body>Not an image</body></html>' * 100), None)
+        self.assertNotEqual(self.upload('RIFF\0\0\0\0WAVEfmt ' + '\0' * 1000), None)
+
+
+class CompiledBoundariesTest(TestCase):
+    # a region with a lake, an island in the lake, and a neighbour sharing
+    # a jagged border, over the equator and the meridian
+    FEATURES = [
+        ('AA', 'West', [[[-3, -2], [0, -2], [0.3, -1], [-0.2, 0], [0.4, 1.1], [0, 2], [-3, 2], [-3, -2]],
+                        [[-2, -1], [-2, 1], [-1, 1], [-1, -1], [-2, -1]]]),
+        ('AA', 'Island', [[[-1.8, -0.5], [-1.2, -0.5], [-1.5, 0.7], [-1.8, -0.5]]]),
+        ('BB', 'East', [[[0, -2], [3, -2], [3, 2], [0, 2], [0.4, 1.1], [-0.2, 0], [0.3, -1], [0, -2]]]),
+    ]
+
+    def setUp(self):
+        features = [{'type': 'Feature', 'properties': {'iso_a2': country, 'name': name},
+                     'geometry': {'type': 'Polygon', 'coordinates': rings}}
+                    for country, name, rings in self.FEATURES]
+        self.source = tempfile.mktemp(suffix='.geojson')
+        self.compiled = tempfile.mktemp(suffix='.boundaries')
+        for filename in (self.source, self.compiled):
+            self.addCleanup(self.remove, filename)
+        simplejson.dump({'type': 'FeatureCollection', 'features': features}, open(self.source, 'w'))
+
+    def remove(self, filename):
+        if os.path.exists(filename):
+            os.unlink(filename)
+
+    def test_same_regions(self):
+        geojson = geodata.BoundariesGeocoder(self.source, 'iso_a2', 'name')
+        for cell_size in (0.25, 1.0):
+            call_command('compile_boundaries', self.source, self.compiled, cell_size=cell_size, verbosity=0)
+            self.assertTrue(geodata.is_compiled(self.compiled))
+            mapped = geodata.MappedGeocoder(self.compiled)
+            found = set()
+            for i in range(-45, 46):
+                for j in range(-45, 46):
+                    lat, lng = i * 0.0501, j * 0.0703
+                    region = mapped.lookup(lat, lng)
+                    self.assertEqual(region, geojson.lookup(lat, lng), (lat, lng))
+                    found.add(region and region['region'])
+            self.assertEqual(found, set([None, 'West', 'Island', 'East']))
+
+    def test_regions(self):
+        call_command('compile_boundaries', self.source, self.compiled, verbosity=0)
+        mapped = geodata.MappedGeocoder(self.compiled)
+        self.assertEqual(mapped.lookup(-0.5, -2.5), {'country': 'AA', 'region': 'West'})
+        self.assertEqual(mapped.lookup(0, -1.5), {'country': 'AA', 'region': 'Island'})
+        self.assertEqual(mapped.lookup(0.9, -1.5), None)
+        self.assertEqual(mapped.lookup(0, 0), {'country': 'BB', 'region': 'East'})
+        self.assertEqual(mapped.lookup(10, 0), None)
+        self.assertFalse(geodata.is_compiled(self.source))
@@ -0,0 +1,176 @@
+"""
+Registry of the resized avatar thumbnails known to exist on the storage, and
+the background workers that generate the missing ones
+"""
+from django.core.cache import cache
+from django.utils.encoding import smart_str
+import Queue
+import hashlib
+import logging
+import os
+import settings
+import threading
+import time
+
+logger = logging.getLogger('userprofile.thumbnails')
+
+# mimetypes of the formats that can be given in AVATAR_MODERN_FORMATS
+FORMAT_MIMETYPES = {
+    'AVIF': 'image/avif',
+    'WEBP': 'image/webp',
+}
+
+
+def modern_formats():
+    """
+    Return the formats of AVATAR_MODERN_FORMATS which the installed PIL is
+    able to write, in order of preference
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        import Image
+    Image.init()
+    return [img_format for img_format in settings.AVATAR_MODERN_FORMATS \
+            if img_format in FORMAT_MIMETYPES and img_format in Image.SAVE]
+
+
+def negotiate_format(accept):
+    """
+    Return the preferred modern format accepted by the client (from the
+    value of an Accept header), or None for the source format
+    """
+    if not accept:
+        return None
+    accepted = [item.split(';')[0].strip() for item in accept.split(',')]
+    for img_format in modern_formats():
+        if FORMAT_MIMETYPES[img_format] in accepted:
+            return img_format
+    return None
+
+
+class ThumbnailRegistry(object):
+    """
+    Remember, in the django cache, which (avatar name, size) thumbnails have
+    already been generated, so rendering an avatar doesn't need to ask the
+    storage (maybe a remote one) if the file exists. img_format is None for
+    the thumbnail in the source format, or one of AVATAR_MODERN_FORMATS.
+    """
+    prefix = 'userprofile.thumbnail'
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+
+    def key(self, name, size, img_format=None):
+        if img_format:
+            size = "%s.%s" % (size, img_format.lower())
+        return "%s.%s" % (self.prefix, hashlib.md5(smart_str("%s:%s" % (name, size))).hexdigest())
+
+    def exists(self, name, size, img_format=None):
+        return bool(cache.get(self.key(name, size, img_format)))
+
+    def exists_many(self, pairs, img_format=None):
+        """
+        Return the set of (name, size) pairs known to exist, with a single
+        cache request
+        """
+        keys = dict((self.key(name, size, img_format), (name, size)) for name, size in pairs)
+        return set(keys[key] for key, value in cache.get_many(keys.keys()).items() if value)
+
+    def add(self, name, size, img_format=None):
+        cache.set(self.key(name, size, img_format), True, self.timeout)
+
+    def add_many(self, name, sizes, formats=(None,)):
+        cache.set_many(dict((self.key(name, size, img_format), True) \
+                            for size in sizes for img_format in formats), self.timeout)
+
+    def discard(self, name, sizes, formats=(None,)):
+        cache.delete_many([self.key(name, size, img_format) \
+                           for size in sizes for img_format in formats])
+
+
+class ThumbnailWorkers(object):
+    """
+    Pool of daemon threads generating missing thumbnails out of the request.
+    Threads are started on the first submit of every process, so it's safe
+    to import this module before the web server forks.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.queue = Queue.Queue()
+        self.pending = set()
+        self.generated = 0
+        self.failed = 0
+        self.total_latency = 0.0
+        self.last_latency = None
+        for i in range(self.size):
+            thread = threading.Thread(target=self.run, name="avatar-thumbnails-%d" % i)
+            thread.setDaemon(True)
+            thread.start()
+
+    def submit(self, avatar, size, img_format=None):
+        """
+        Queue the generation of a thumbnail, unless it's already queued.
+        """
+        key = (avatar.image.name, size, img_format)
+        self.lock.acquire()
+        try:
+            if self.pid != os.getpid():
+                self.reset()
+            if key in self.pending:
+                return
+            self.pending.add(key)
+        finally:
+            self.lock.release()
+        self.queue.put((time.time(), avatar, size, img_format))
+
+    def run(self):
+        while True:
+            queued, avatar, size, img_format = self.queue.get()
+            try:
+                try:
+                    if avatar.image.storage.exists(avatar.get_resized_image_filename(size, img_format=img_format)):
+                        registry.add(avatar.image.name, size, img_format)
+                    else:
+                        avatar.generate_resized_image(size, [img_format])
+                except:
+                    self.failed += 1
+                    logger.exception("Can't generate the %s thumbnail of %s" % (size, avatar.image.name))
+                else:
+                    latency = time.time() - queued
+                    self.generated += 1
+                    self.total_latency += latency
+                    self.last_latency = latency
+                    logger.debug("Generated the %s thumbnail of %s in %.3fs (%d queued)" % \
+                                 (size, avatar.image.name, latency, self.queue.qsize()))
+            finally:
+                self.lock.acquire()
+                try:
+                    self.pending.discard((avatar.image.name, size, img_format))
+                finally:
+                    self.lock.release()
+
+    def stats(self):
+        """
+        Queue depth and generation latency (seconds, from queued to saved)
+        of the workers of the current process
+        """
+        if self.pid != os.getpid():
+            return {'queued': 0, 'generated': 0, 'failed': 0, 'average_latency': None, 'last_latency': None}
+        return {
+            'queued': len(self.pending),
+            'generated': self.generated,
+            'failed': self.failed,
+            'average_latency': self.generated and self.total_latency / self.generated or None,
+            'last_latency': self.last_latency,
+        }
+
+
+registry = ThumbnailRegistry(settings.AVATAR_THUMBNAIL_CACHE_TIMEOUT)
+workers = ThumbnailWorkers(settings.AVATAR_THUMBNAIL_WORKERS)
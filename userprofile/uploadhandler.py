@@ -2,9 +2,55 @@
 Upload handlers to test the upload API.
 """
 
-from django.conf import settings
 from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+from django.utils.translation import ugettext as _
 from exceptions import CustomUploadError
+import hashlib
+import struct
+import userprofile.settings
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+# signatures of the image formats accepted as avatars
+SIGNATURES = ('\xff\xd8\xff', '\x89PNG\r\n\x1a\n', 'GIF87a', 'GIF89a', 'BM', 'RIFF')
+
+def is_image_header(header):
+    """
+    Whether the first (12 or more) bytes of a file match the signature of an
+    image format accepted as avatar
+    """
+    if header.startswith('RIFF'):
+        return header[8:12] == 'WEBP'
+    return header.startswith(SIGNATURES)
+
+def webp_size(header):
+    """
+    Width and height of a WebP image from its first 30 bytes, as PIL can't
+    open an incomplete WebP file. Return None if they can't be read.
+    """
+    if len(header) < 30 or header[:4] != 'RIFF' or header[8:12] != 'WEBP':
+        return None
+    chunk = header[12:16]
+    if chunk == 'VP8 ' and header[23:26] == '\x9d\x01\x2a':
+        # lossy: 14 bits dimensions after the key frame start code
+        width, height = struct.unpack('<HH', header[26:30])
+        return width & 0x3fff, height & 0x3fff
+    if chunk == 'VP8L' and header[20] == '\x2f':
+        # lossless: 14 bits dimensions minus one, packed
+        bits = struct.unpack('<I', header[21:25])[0]
+        return (bits & 0x3fff) + 1, (bits >> 14 & 0x3fff) + 1
+    if chunk == 'VP8X':
+        # extended: 24 bits canvas dimensions minus one
+        width = struct.unpack('<I', header[24:27] + '\0')[0] + 1
+        height = struct.unpack('<I', header[27:30] + '\0')[0] + 1
+        return width, height
+    return None
 
 class QuotaUploadHandler(FileUploadHandler):
     """
@@ -12,15 +58,15 @@ class QuotaUploadHandler(FileUploadHandler):
     (1MB) is uploaded.
     """
 
-    QUOTA = settings.AVATAR_QUOTA * 2 ** 20 # 1 MB
-
     def __init__(self, request=None):
         super(QuotaUploadHandler, self).__init__(request)
+        # read here, so importing this module doesn't require AVATAR_QUOTA
+        self.QUOTA = (userprofile.settings.AVATAR_QUOTA or 0) * 2 ** 20
         self.total_upload = 0
 
     def receive_data_chunk(self, raw_data, start):
         self.total_upload += len(raw_data)
-        if self.total_upload >= self.QUOTA:
+        if self.QUOTA and self.total_upload >= self.QUOTA:
             raise StopUpload(connection_reset=True)
         return raw_data
 
@@ -28,6 +74,92 @@ class QuotaUploadHandler(FileUploadHandler):
         return None
 
 
+class AvatarUploadHandler(FileUploadHandler):
+    """
+    Reject avatar uploads as early as possible: requests bigger than
+    AVATAR_QUOTA from their Content-Length, before the body is read, and
+    files that don't start with a supported image signature or whose
+    declared dimensions exceed AVATAR_MAX_PIXELS, from their first chunks.
+    The reason is left on request.avatar_upload_error.
+
+    The SHA-1 of every accepted file is computed while it streams in and
+    left on request.avatar_upload_digests (field name => hex digest).
+    """
+
+    # bytes to buffer, at most, until the image header can be parsed
+    SNIFF_LIMIT = 256 * 2 ** 10
+
+    def __init__(self, request=None):
+        super(AvatarUploadHandler, self).__init__(request)
+        self.quota = userprofile.settings.AVATAR_QUOTA and userprofile.settings.AVATAR_QUOTA * 2 ** 20
+        self.total_upload = 0
+        self.error = None
+        if request is not None:
+            request.avatar_upload_digests = {}
+
+    def reject(self, error):
+        self.error = error
+        if self.request is not None:
+            self.request.avatar_upload_error = error
+        raise StopUpload(connection_reset=True)
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        if self.quota and content_length > self.quota:
+            # raised on new_file(), where StopUpload is handled by the parser
+            self.error = _("The image is bigger than %d MB") % userprofile.settings.AVATAR_QUOTA
+        return None
+
+    def new_file(self, *args, **kwargs):
+        super(AvatarUploadHandler, self).new_file(*args, **kwargs)
+        if self.error:
+            self.reject(self.error)
+        self.header = ''
+        self.checked = False
+        self.digest = hashlib.sha1()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.total_upload += len(raw_data)
+        if self.quota and self.total_upload >= self.quota:
+            self.reject(_("The image is bigger than %d MB") % userprofile.settings.AVATAR_QUOTA)
+        if not self.checked:
+            self.header += raw_data
+            self.check_header()
+        self.digest.update(raw_data)
+        return raw_data
+
+    def check_header(self):
+        if len(self.header) < 12:
+            return
+        if not is_image_header(self.header):
+            self.reject(_("This image can't be used as an avatar"))
+        if self.header.startswith('RIFF'):
+            if len(self.header) < 30:
+                return
+            size = webp_size(self.header)
+            if size is None:
+                self.reject(_("This image can't be used as an avatar"))
+            width, height = size
+        else:
+            try:
+                width, height = Image.open(StringIO(self.header)).size
+            except Exception:
+                # the header may not be complete yet
+                if len(self.header) >= self.SNIFF_LIMIT:
+                    self.reject(_("This image can't be used as an avatar"))
+                return
+        if width * height > userprofile.settings.AVATAR_MAX_PIXELS:
+            self.reject(_("The image is too big (%(width)dx%(height)d pixels)") % { 'width': width, 'height': height })
+        self.checked = True
+        self.header = ''
+
+    def file_complete(self, file_size):
+        if not self.checked:
+            self.reject(_("This image can't be used as an avatar"))
+        if self.request is not None:
+            self.request.avatar_upload_digests[self.field_name] = self.digest.hexdigest()
+        return None
+
+
 class ErroringUploadHandler(FileUploadHandler):
     """A handler that raises an exception."""
     def receive_data_chunk(self, raw_data, start):
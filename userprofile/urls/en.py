@@ -18,6 +18,9 @@ urlpatterns = patterns('',
         name='profile_geocountry_info'),
 
     # Avatars
+    url(r'^profile/avatar/(?P<username>[^/]+)/(?P<size>\d+)/$', avatar_image,
+        name='profile_avatar_image'),
+
     url(r'^profile/edit/avatar/delete/$', avatardelete,
         name='profile_avatar_delete'),
 
@@ -41,6 +44,10 @@ urlpatterns = patterns('',
     url(r'^email/validation/(?P<key>.{70})/$', email_validation_process,
         name='email_validation_process'),
 
+    # signed keys, see EMAIL_VALIDATION_SIGNED
+    url(r'^email/validation/(?P<key>[0-9a-z]+-[0-9a-z]+-[01]-[0-9A-Za-z_\-]+)/$',
+        email_validation_process, name='email_validation_process'),
+
     url(r'^email/validation/reset/$', email_validation_reset,
         name='email_validation_reset'),
 
@@ -98,6 +105,12 @@ urlpatterns = patterns('',
          'template': 'userprofile/account/registration_done.html'},
         name='signup_complete'),
 
+    # Country directory
+    url(r'^countries/$', country_list, name='profile_country_list'),
+
+    url(r'^countries/(?P<country>[A-Za-z]{2})/$', country_profiles,
+        name='profile_country'),
+
     # Users public profile
     url(r'^profile/(?P<username>.+)/$', public, name='profile_public'),
 
@@ -18,6 +18,9 @@ urlpatterns = patterns('',
         name='profile_geocountry_info'),
 
     # Avatars
+    url(r'^perfil/avatar/(?P<username>[^/]+)/(?P<size>\d+)/$', avatar_image,
+        name='profile_avatar_image'),
+
     url(r'^perfil/editar/avatar/eliminar/$', avatardelete,
         name='profile_avatar_delete'),
 
@@ -41,6 +44,10 @@ urlpatterns = patterns('',
     url(r'^email/validar/(?P<key>.{70})/$', email_validation_process,
         name='email_validation_process'),
 
+    # signed keys, see EMAIL_VALIDATION_SIGNED
+    url(r'^email/validar/(?P<key>[0-9a-z]+-[0-9a-z]+-[01]-[0-9A-Za-z_\-]+)/$',
+        email_validation_process, name='email_validation_process'),
+
     url(r'^email/validar/reestablecer/$', email_validation_reset,
         name='email_validation_reset'),
 
@@ -99,6 +106,12 @@ urlpatterns = patterns('',
          'template': 'userprofile/account/registration_done.html'},
         name='signup_complete'),
 
+    # Country directory
+    url(r'^paises/$', country_list, name='profile_country_list'),
+
+    url(r'^paises/(?P<country>[A-Za-z]{2})/$', country_profiles,
+        name='profile_country'),
+
     # Users public profile
     url(r'^perfil/(?P<username>.+)/$', public, name='profile_public'),
 
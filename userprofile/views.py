@@ -1,37 +1,41 @@
-from cStringIO import StringIO
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User, SiteProfileNotAvailable
 from django.core.exceptions import ImproperlyConfigured
-from django.core.files.base import ContentFile, File
+from django.core.paginator import Paginator, EmptyPage
 from django.core.urlresolvers import reverse
 from django.db import models
-from django.http import Http404, HttpResponseRedirect, HttpResponse
+from django.http import Http404, HttpResponseRedirect, HttpResponse, \
+    HttpResponseNotModified
 from django.shortcuts import render_to_response, get_object_or_404
 from django.template import RequestContext
 from django.utils import simplejson
-from django.utils.encoding import iri_to_uri
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.encoding import iri_to_uri, smart_str
+from django.utils.http import http_date, parse_http_date_safe
 from django.utils.translation import ugettext as _
-from userprofile import signals
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from userprofile import geodata, signals
+from userprofile.countries import get_choices, get_country_name
 from userprofile.exceptions import GoogleDataAPINotFound
 from userprofile.forms import AvatarForm, AvatarCropForm, EmailValidationForm, \
     ProfileForm, _RegistrationForm, LocationForm, ResendEmailValidationForm
-from userprofile.models import BaseProfile, EmailValidation, Avatar
-from userprofile.settings import DEFAULT_AVATAR_SIZE, SAVE_IMG_PARAMS, \
-    DEFAULT_AVATAR, MIN_AVATAR_SIZE, AVATAR_QUOTA, AVATAR_WEBSEARCH, \
-    GOOGLE_MAPS_API_KEY
-from xml.dom import minidom
+from userprofile.models import BaseProfile, EmailValidation, Avatar, CountryCount, \
+    open_image, shrink_image, encode_image
+from userprofile.settings import DEFAULT_AVATAR_SIZE, DEFAULT_AVATAR, \
+    MIN_AVATAR_SIZE, AVATAR_WEBSEARCH, GOOGLE_MAPS_API_KEY, AVATAR_SIZES, \
+    AVATAR_SERVE_BACKEND, AVATAR_SERVE_PREFIX, AVATAR_SERVE_MAX_AGE, \
+    COUNTRY_DIRECTORY_PAGE_SIZE
+from userprofile.thumbnails import negotiate_format
+from userprofile.uploadhandler import AvatarUploadHandler
 import copy
+import hashlib
+import mimetypes
 import os
-import urllib
+import time
 
 
-try:
-    from PIL import Image
-except ImportError:
-    import Image
-
 if not settings.AUTH_PROFILE_MODULE:
     raise SiteProfileNotAvailable
 try:
@@ -51,23 +55,73 @@ if AVATAR_WEBSEARCH:
         raise GoogleDataAPINotFound
 
 def get_profiles():
-    return Profile.objects.order_by("-creation_date")
+    return Profile.objects.select_related("user").order_by("-creation_date")
 
 def fetch_geodata(request, lat, lng):
     if request.META.get('HTTP_X_REQUESTED_WITH') == 'XMLHttpRequest':
-        url = "http://ws.geonames.org/countrySubdivision?lat=%s&lng=%s" % (lat, lng)
-        dom = minidom.parse(urllib.urlopen(url))
-        country = dom.getElementsByTagName('countryCode')
-        if len(country) >= 1:
-            country = country[0].childNodes[0].data
-        region = dom.getElementsByTagName('adminName1')
-        if len(region) >= 1:
-            region = region[0].childNodes[0].data
-
-        return HttpResponse(simplejson.dumps({'success': True, 'country': country, 'region': region}))
+        try:
+            found = geodata.lookup(float(lat), float(lng))
+        except ValueError:
+            raise Http404()
+        data = {'success': found is not None, 'country': '', 'region': ''}
+        data.update(found or {})
+        return HttpResponse(simplejson.dumps(data))
     else:
         raise Http404()
 
+class CountedProfiles(object):
+    """
+    Queryset of profiles whose count is already known, so paginating it
+    doesn't run a COUNT query
+    """
+    def __init__(self, queryset, count):
+        self.queryset = queryset
+        self._count = count
+
+    def count(self):
+        return self._count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, key):
+        return self.queryset[key]
+
+def country_list(request):
+    """
+    Countries with profiles, and their number of profiles
+    """
+    counts = CountryCount.objects.get_counts()
+    countries = [{ 'code': code, 'name': name, 'count': counts[code] } \
+                 for code, name in get_choices() if counts.get(code)]
+
+    template = "userprofile/profile/countries.html"
+    data = { 'countries': countries }
+    signals.context_signal.send(sender=country_list, request=request, context=data)
+    return render_to_response(template, data, context_instance=RequestContext(request))
+
+def country_profiles(request, country):
+    """
+    Paginated list of the profiles of a country, newest first
+    """
+    country = country.upper()
+    country_name = get_country_name(country)
+    if country_name is None:
+        raise Http404
+    count = CountryCount.objects.get_counts().get(country, 0)
+    profiles = CountedProfiles(get_profiles().filter(country=country).order_by("-id"), count)
+    try:
+        page = Paginator(profiles, COUNTRY_DIRECTORY_PAGE_SIZE).page(int(request.GET.get('page', 1)))
+    except (ValueError, EmptyPage):
+        raise Http404
+    page.object_list = list(page.object_list)
+
+    template = "userprofile/profile/country.html"
+    data = { 'country': country, 'country_name': country_name, 'page': page,
+             'DEFAULT_AVATAR_SIZE': DEFAULT_AVATAR_SIZE }
+    signals.context_signal.send(sender=country_profiles, request=request, context=data)
+    return render_to_response(template, data, context_instance=RequestContext(request))
+
 def public(request, username):
     try:
         profile = User.objects.get(username=username).get_profile()
@@ -136,11 +190,10 @@ def location(request):
     Location selection of the user profile
     """
     profile, created = Profile.objects.get_or_create(user=request.user)
+    old_country = profile.country
     geoip = hasattr(settings, "GEOIP_PATH")
     if geoip and request.method == "GET" and request.GET.get('ip') == "1":
-        from django.contrib.gis.utils import GeoIP
-        g = GeoIP()
-        c = g.city(request.META.get("REMOTE_ADDR"))
+        c = geodata.geoip.city(request.META.get("REMOTE_ADDR"))
         if c and c.get("latitude") and c.get("longitude"):
             profile.latitude = "%.6f" % c.get("latitude")
             profile.longitude = "%.6f" % c.get("longitude")
@@ -151,6 +204,7 @@ def location(request):
         form = LocationForm(request.POST, instance=profile)
         if form.is_valid():
             form.save()
+            CountryCount.objects.change(old_country, profile.country)
             messages.success(request, _("Your profile information has been updated successfully."), fail_silently=True)
 
             signal_responses = signals.post_signal.send(sender=location, request=request, form=form)
@@ -176,8 +230,9 @@ def delete(request):
 
         # Remove the profile and all the information
         Profile.objects.filter(user=request.user).delete()
+        CountryCount.objects.change(profile.country, None)
         EmailValidation.objects.filter(user=request.user).delete()
-        Avatar.objects.filter(user=request.user).delete()
+        Avatar.objects.delete_avatars(Avatar.objects.filter(user=request.user))
 
         # Remove the e-mail of the account too
         request.user.email = ''
@@ -195,18 +250,22 @@ def delete(request):
     signals.context_signal.send(sender=delete, request=request, context=data)
     return render_to_response(template, data, context_instance=RequestContext(request))
 
+@csrf_exempt
 @login_required
 def avatarchoose(request):
     """
     Avatar choose
     """
+    # the upload handler must be installed before anything reads request.POST,
+    # CsrfViewMiddleware included, so the CSRF check is done by _avatarchoose
+    request.upload_handlers.insert(0, AvatarUploadHandler(request))
+    return _avatarchoose(request)
+
+@csrf_protect
+def _avatarchoose(request):
     Profile.objects.get_or_create(user=request.user)
     images = dict()
 
-    if AVATAR_QUOTA:
-        from userprofile.uploadhandler import QuotaUploadHandler
-        request.upload_handlers.insert(0, QuotaUploadHandler())
-
     if request.method == "POST":
         form = AvatarForm()
         if request.POST.get('keyword'):
@@ -218,33 +277,33 @@ def avatarchoose(request):
 
         else:
             form = AvatarForm(request.POST, request.FILES)
-            if form.is_valid():
+            upload_error = getattr(request, 'avatar_upload_error', None)
+            if upload_error:
+                messages.error(request, upload_error)
+            elif form.is_valid():
                 image = form.cleaned_data.get('url') or form.cleaned_data.get('photo')
                 try:
-                    thumb = Image.open(ContentFile(image.read()))
+                    image.seek(0)
+                    thumb, img_format = open_image(image, 480)
                 except:
                     messages.error(request, _("This image can't be used as an avatar"))
                 else:
-                    if thumb.mode != "RGB":
-                        thumb = thumb.convert("RGB")
-                    thumb.thumbnail((480, 480), Image.ANTIALIAS)
-                    f = File(StringIO(), name=image.name)
-                    try:
-                        thumb.save(f, thumb.format, **SAVE_IMG_PARAMS.get(thumb.format, {}))
-                    except:
-                        thumb.save(f, thumb.format)
-                    f.seek(0)
+                    image.close()
+                    shrink_image(thumb, 480)
+                    f = encode_image(thumb, img_format, image.name)
                     file_ext = image.content_type.split("/")[1] # "image/gif" => "gif"
                     if file_ext == 'pjpeg':
                         file_ext = 'jpeg'
                     try:
                         avatar = Avatar.objects.get(user=request.user, valid=False)
-                        avatar.delete_avatar_thumbs()
-                        avatar.image.delete()
                     except Avatar.DoesNotExist:
                         avatar = Avatar(user=request.user, image="", valid=False)
-                    avatar.image.save("%s.%s" % (request.user.username, file_ext), ContentFile(f.read()))
-                    avatar.save()
+                    digest = None
+                    if not form.cleaned_data.get('url'):
+                        # computed while the file was uploaded, see AvatarUploadHandler
+                        digest = request.avatar_upload_digests.get('photo')
+                    avatar.replace_image("%s.%s" % (request.user.username, file_ext), f, digest)
+                    f.close()
 
                     signal_responses = signals.post_signal.send(sender=avatarchoose, request=request, form=form)
                     return signals.last_response(signal_responses) or HttpResponseRedirect(reverse("profile_avatar_crop"))
@@ -279,9 +338,8 @@ def avatarcrop(request):
     if not request.method == "POST":
         form = AvatarCropForm()
     else:
-        image = Image.open(ContentFile(avatar.image.read()))
-        if image.mode != "RGB":
-            image = image.convert("RGB")
+        image, img_format = open_image(avatar.image)
+        avatar.image.close()
         form = AvatarCropForm(image, request.POST)
         if form.is_valid():
             top = int(form.cleaned_data.get('top'))
@@ -305,22 +363,24 @@ def avatarcrop(request):
             box = [ left, top, right, bottom ]
             image = image.crop(box)
 
-            for a in Avatar.objects.filter(user=request.user).exclude(id=avatar.id):
-                a.delete()
+            # the images are deleted once the new one is stored, so an
+            # identical (content-addressed) image isn't removed under it
+            old_avatars = Avatar.objects.delete_avatars(Avatar.objects.filter(user=request.user) \
+                                                        .exclude(id=avatar.id), images=False)
 
-            f = File(StringIO(), name=avatar.image.name) # need if format is empty
-            image.save(f, image.format)
-            f.seek(0)
+            f = encode_image(image, img_format, avatar.image.name)
             if hasattr(image, 'content_type'):
                 file_ext = image.content_type.split("/")[1] # "image/gif" => "gif"
             else:
                 file_ext = os.path.splitext(avatar.image.name)[1][1:]
             if file_ext == 'pjpeg':
                 file_ext = 'jpeg'
-            avatar.image.delete()
-            avatar.image.save("%s.%s" % (request.user.username, file_ext), ContentFile(f.read()))
             avatar.valid = True
-            avatar.save()
+            created = avatar.replace_image("%s.%s" % (request.user.username, file_ext), f)
+            f.close()
+            if created:
+                avatar.create_resized_images(image, img_format)
+            Avatar.objects.delete_images(old_avatars)
             messages.success(request, _("Your new avatar has been saved successfully."), fail_silently=True)
 
             signal_responses = signals.post_signal.send(sender=avatarcrop, request=request, form=form)
@@ -337,12 +397,79 @@ def avatarcrop(request):
     signals.context_signal.send(sender=avatarcrop, request=request, context=data)
     return render_to_response(template, data, context_instance=RequestContext(request))
 
+def avatar_image(request, username, size):
+    """
+    Serve the current avatar of a user with a stable url. Local files are
+    handed off to the front-end server (X-Sendfile or X-Accel-Redirect,
+    see AVATAR_SERVE_BACKEND) with ETag and Last-Modified headers,
+    everything else is redirected to the storage url.
+    """
+    size = int(size)
+    if not size in AVATAR_SIZES:
+        raise Http404
+
+    try:
+        profile = Profile.objects.select_related('user').get(user__username=username)
+    except Profile.DoesNotExist:
+        user = get_object_or_404(User, username=username)
+    else:
+        user = profile.user
+        user._profile_cache = profile
+
+    avatar = Avatar.objects.get_for_user(user)
+    img_format = negotiate_format(request.META.get('HTTP_ACCEPT'))
+    url = avatar.get_resized_image_url(size, img_format)
+    filename = avatar.get_resized_image_filename(size, img_format=img_format)
+    if url != avatar.image.storage.url(filename):
+        # lost avatar or thumbnail still being generated, the default is served
+        avatar = Avatar.objects.get_default_avatar()
+        filename = avatar.get_resized_image_filename(size, img_format=img_format)
+
+    path = None
+    if not avatar.is_default:
+        # only the avatars storage is under AVATAR_SERVE_PREFIX, the default
+        # avatar lives in the static files storage
+        try:
+            path = avatar.image.storage.path(filename)
+        except NotImplementedError:
+            pass
+    if not (AVATAR_SERVE_BACKEND and path):
+        response = HttpResponseRedirect(url)
+        patch_cache_control(response, public=True, max_age=AVATAR_SERVE_MAX_AGE)
+        patch_vary_headers(response, ('Accept',))
+        return response
+
+    try:
+        modified = int(time.mktime(avatar.image.storage.modified_time(filename).timetuple()))
+    except (OSError, NotImplementedError):
+        raise Http404
+    etag = '"%s"' % hashlib.md5(smart_str("%s:%s" % (filename, modified))).hexdigest()
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    if if_none_match is not None:
+        not_modified = etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*'
+    else:
+        not_modified = if_modified_since is not None and modified <= if_modified_since
+    if not_modified:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(content_type=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        if AVATAR_SERVE_BACKEND == 'accel-redirect':
+            response['X-Accel-Redirect'] = iri_to_uri(AVATAR_SERVE_PREFIX + filename.replace(os.sep, '/'))
+        else:
+            response['X-Sendfile'] = smart_str(path)
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(modified)
+    patch_cache_control(response, public=True, max_age=AVATAR_SERVE_MAX_AGE)
+    patch_vary_headers(response, ('Accept',))
+    return response
+
 @login_required
 def avatardelete(request, avatar_id=False):
     if request.META.get('HTTP_X_REQUESTED_WITH') == 'XMLHttpRequest':
         try:
-            for avatar in Avatar.objects.filter(user=request.user):
-                avatar.delete()
+            Avatar.objects.delete_avatars(Avatar.objects.filter(user=request.user))
             return HttpResponse(simplejson.dumps({'success': True}))
         except:
             return HttpResponse(simplejson.dumps({'success': False}))
@@ -409,10 +536,9 @@ def email_validation_reset(request):
     Resend the validation email
     """
     if request.user.is_authenticated():
-        try:
-            EmailValidation.objects.exclude(verified=True).get(user=request.user).resend()
+        if EmailValidation.objects.resend(user=request.user):
             response = "done"
-        except EmailValidation.DoesNotExist:
+        else:
             response = "failed"
 
         signal_responses = signals.post_signal.send(sender=email_validation_reset, request=request, extra={'response': response})
@@ -423,10 +549,9 @@ def email_validation_reset(request):
             form = ResendEmailValidationForm(request.POST)
             if form.is_valid():
                 email = form.cleaned_data.get('email')
-                try:
-                    EmailValidation.objects.exclude(verified=True).get(email=email).resend()
+                if EmailValidation.objects.resend(email=email):
                     response = "done"
-                except EmailValidation.DoesNotExist:
+                else:
                     response = "failed"
 
                 signal_responses = signals.post_signal.send(sender=email_validation_reset, request=request, extra={'response': response})